@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+IELTS Pro Bot - handlerlar uchun yuklama testi
+Soxta Bot API va soxta AI bilan N ta foydalanuvchini parallel simulyatsiya qiladi
+
+Misol:
+    python bench_handlers.py --users 200 --updates 20 --backend json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Handlerlar uchun yuklama testi")
+    parser.add_argument('--users', type=int, default=100, help="Parallel foydalanuvchilar soni")
+    parser.add_argument('--updates', type=int, default=20, help="Har bir foydalanuvchi yuboradigan update soni")
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json', help="Saqlash turi")
+    parser.add_argument('--api-latency', type=float, default=30.0, help="Bot API javob vaqti (ms)")
+    parser.add_argument('--ai-latency', type=float, default=1500.0, help="AI javob vaqti (ms)")
+    parser.add_argument('--channels', type=int, default=2, help="Majburiy kanallar soni")
+    parser.add_argument('--bot-admin', action='store_true', help="Bot kanallarda admin (a'zolik indeksi)")
+    parser.add_argument('--rate-limits', action='store_true',
+                        help="Standart so'rov cheklovlarini qoldirish (aks holda o'chiriladi)")
+    parser.add_argument('--seed', type=int, default=1, help="Tasodifiy sonlar uchun seed")
+    return parser.parse_args()
+
+
+ARGS = parse_args()
+
+# ielts_bot import qilinishidan oldin: vaqtinchalik papka, haqiqiy AI kalitlarsiz
+os.environ['DATA_DIR'] = tempfile.mkdtemp(prefix='ielts_bench_')
+os.environ['STORAGE_BACKEND'] = ARGS.backend
+os.environ['OPENAI_API_KEY'] = ''
+os.environ['GEMINI_API_KEY'] = ''
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import ielts_bot  # noqa: E402
+
+BOT_ID = 1000000
+BOT_USER = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+# Update turlari va ulushlari
+MIX = [
+    ("start", 0.15),
+    ("code", 0.15),
+    ("ai", 0.45),
+    ("new_code", 0.10),
+    ("check_subscription", 0.05),
+    ("materials", 0.10),
+]
+
+AI_QUESTIONS = [
+    "IELTS Writing Task 2 uchun maslahat bering",
+    "Band 7 uchun nima qilish kerak?",
+    "Speaking Part 2 ga qanday tayyorlanaman?",
+    "Listening bo'limida vaqtni qanday taqsimlash kerak?",
+]
+
+
+# ==================== SOXTA BOT API ====================
+
+class StubRequest(BaseRequest):
+    """Bot API ga so'rov yubormasdan, kechikish bilan soxta javob qaytaradi"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        chat_id = params.get("chat_id", 1)
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data else {}
+
+        if endpoint != 'getMe':
+            await asyncio.sleep(self.latency)
+
+        if endpoint == 'getMe':
+            result = dict(BOT_USER, can_join_groups=True, can_read_all_group_messages=False,
+                          supports_inline_queries=False)
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            result = self._message(params)
+        elif endpoint == 'getChatMember':
+            result = {"status": "member", "user": {"id": params.get("user_id"), "is_bot": False, "first_name": "U"}}
+        else:
+            result = True
+
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# ==================== SOXTA AI ====================
+
+class FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """generate_content: haqiqiy klient kabi sinxron kutadi"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    def generate_content(self, prompt, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        return FakeGeminiResponse(f"Javob: {str(prompt)[-40:]}")
+
+    async def generate_content_async(self, prompt, stream=False, **kwargs):
+        self.calls += 1
+        text = f"Javob: {str(prompt)[-40:]}"
+        if stream:
+            return self._stream(text)
+        await asyncio.sleep(self.latency)
+        return FakeGeminiResponse(text)
+
+    async def _stream(self, text: str, chunks: int = 10):
+        """Javobni teng bo'laklarda, umumiy kechikish davomida qaytarish"""
+        step = max(1, len(text) // chunks)
+        for i in range(0, len(text), step):
+            await asyncio.sleep(self.latency / chunks)
+            yield FakeGeminiResponse(text[i:i + step])
+
+
+# ==================== UPDATE YASASH ====================
+
+def make_user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+
+def make_message(update_id: int, uid: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": make_user(uid),
+        "text": text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": update_id, "message": message}
+
+
+def make_callback(update_id: int, uid: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": make_user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": BOT_USER,
+                "text": "...",
+            },
+        },
+    }
+
+
+def build_update(kind: str, update_id: int, uid: int, rnd: random.Random) -> dict:
+    if kind == "start":
+        return make_message(update_id, uid, "/start")
+    if kind == "code":
+        return make_message(update_id, uid, "🔑 Kod olish")
+    if kind == "ai":
+        return make_message(update_id, uid, rnd.choice(AI_QUESTIONS))
+    if kind == "materials":
+        return make_message(update_id, uid, "📚 IELTS Materiallari")
+    return make_callback(update_id, uid, kind)
+
+
+def pick_kind(rnd: random.Random) -> str:
+    x = rnd.random()
+    for kind, share in MIX:
+        if x < share:
+            return kind
+        x -= share
+    return MIX[-1][0]
+
+
+# ==================== O'LCHASH ====================
+
+def disk_written() -> int:
+    """Jarayon yozgan baytlar (Linux /proc/self/io)"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return -1
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+# Update boshlangan vaqt
+UPDATE_STARTED: Dict[int, float] = {}
+
+
+def track_ai_answers(latencies: Dict[str, List[float]]):
+    """AI javobi foydalanuvchiga yetgunicha ketgan vaqtni o'lchash ("ai_answer")"""
+    original = ielts_bot.process_ai_message
+
+    async def tracked(update, context, question, **kwargs):
+        await original(update, context, question, **kwargs)
+        # Birlashtirilgan savol oxirgi xabardan boshlab o'lchanadi
+        started = UPDATE_STARTED.get(update.update_id)
+        if started is not None:
+            latencies.setdefault("ai_answer", []).append(time.perf_counter() - started)
+
+    ielts_bot.process_ai_message = tracked
+
+
+async def simulate_user(application: Application, uid: int, count: int, counter: List[int],
+                        latencies: Dict[str, List[float]], rnd: random.Random):
+    """Bitta foydalanuvchi: /start, so'ng tasodifiy update'lar ketma-ket"""
+    for i in range(count):
+        kind = "start" if i == 0 else pick_kind(rnd)
+        counter[0] += 1
+        update = Update.de_json(build_update(kind, counter[0], uid, rnd), application.bot)
+
+        started = time.perf_counter()
+        UPDATE_STARTED[update.update_id] = started
+        # Polling'dagi kabi update_processor orqali
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+
+async def run():
+    rnd = random.Random(ARGS.seed)
+    request = StubRequest(ARGS.api_latency / 1000)
+    gemini = FakeGeminiModel(ARGS.ai_latency / 1000)
+    ielts_bot.gemini_model = gemini
+    ielts_bot.openai_client = None
+
+    settings = ielts_bot.get_settings_copy()
+    settings["ai_provider"] = "gemini"
+    settings["required_channels"] = [
+        {"chat_id": -100 - i, "username": f"channel{i}", "title": f"Kanal {i}", "url": None,
+         "bot_admin": ARGS.bot_admin}
+        for i in range(ARGS.channels)
+    ]
+    if not ARGS.rate_limits:
+        # Cheklovchi rad etgan update'lar handler kechikishini o'lchamaydi
+        settings["rate_limits"] = {
+            kind: {scope: [1_000_000, 1] for scope in limits}
+            for kind, limits in ielts_bot.DEFAULT_SETTINGS["rate_limits"].items()
+        }
+    ielts_bot.save_settings(settings)
+
+    application = ielts_bot.build_application(
+        Application.builder().token("1:BENCH").request(request).get_updates_request(StubRequest(0))
+    )
+
+    latencies: Dict[str, List[float]] = {}
+    counter = [0]
+    track_ai_answers(latencies)
+
+    async with application:
+        ielts_bot.data_writer.start()
+        bytes_before = disk_written()
+        started = time.perf_counter()
+
+        await asyncio.gather(*[
+            simulate_user(application, 10_000 + n, ARGS.updates, counter, latencies, random.Random(rnd.random()))
+            for n in range(ARGS.users)
+        ])
+        while ielts_bot.ai_sessions.tasks():
+            await asyncio.gather(*ielts_bot.ai_sessions.tasks(), return_exceptions=True)
+
+        elapsed = time.perf_counter() - started
+        ielts_bot.flush_all()
+        await ielts_bot.data_writer.close()
+        bytes_written = disk_written() - bytes_before
+
+    total = sum(len(v) for kind, v in latencies.items() if kind != "ai_answer")
+    all_latencies = [x for kind, v in latencies.items() if kind != "ai_answer" for x in v]
+
+    print("=" * 64)
+    print(f"IELTS Pro Bot yuklama testi - {datetime.now().isoformat(timespec='seconds')}")
+    print(f"Saqlash: {ARGS.backend} | foydalanuvchilar: {ARGS.users} | update/foydalanuvchi: {ARGS.updates}")
+    print(f"Bot API: {ARGS.api_latency:.0f} ms | AI: {ARGS.ai_latency:.0f} ms | kanallar: {ARGS.channels}")
+    print("=" * 64)
+    print(f"Update'lar:      {total}")
+    print(f"Vaqt:            {elapsed:.2f} s")
+    print(f"O'tkazuvchanlik: {total / elapsed:.1f} update/s")
+    print(f"Kechikish:       p50={percentile(all_latencies, 50) * 1000:.0f} ms  "
+          f"p95={percentile(all_latencies, 95) * 1000:.0f} ms  "
+          f"p99={percentile(all_latencies, 99) * 1000:.0f} ms")
+    if bytes_written >= 0:
+        print(f"Disk:            {bytes_written} bayt ({bytes_written / max(total, 1):.0f} bayt/update)")
+    print("-" * 64)
+    print(f"{'tur':<20}{'soni':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, values in sorted(latencies.items()):
+        print(f"{kind:<20}{len(values):>8}"
+              f"{percentile(values, 50) * 1000:>10.0f}"
+              f"{percentile(values, 95) * 1000:>10.0f}"
+              f"{percentile(values, 99) * 1000:>10.0f}")
+    print("-" * 64)
+    print(f"AI chaqiruvlari: {gemini.calls}")
+    print(f"Cheklovchi rad etgan: {ielts_bot.rate_limiter.rejected}")
+    print("Bot API: " + ", ".join(f"{name}={n}" for name, n in sorted(request.calls.items())))
+
+
+if __name__ == '__main__':
+    logging.disable(logging.WARNING)
+    try:
+        asyncio.run(run())
+    finally:
+        shutil.rmtree(os.environ['DATA_DIR'], ignore_errors=True)
@@ -6,20 +6,33 @@ Ro'yxatdan o'tish, majburiy kanal, AI chat funksiyalari bilan
 """
 
 import os
+import sys
 import json
-import random
-import string
+import time
+import heapq
+import secrets
+import shutil
+import hashlib
+import hmac
+import statistics
 import logging
 import asyncio
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from types import MappingProxyType
+from typing import Awaitable, Callable, Dict, List, Mapping, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application, BaseUpdateProcessor, ChatMemberHandler, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 from dotenv import load_dotenv
 
 # OpenAI import
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI
     OPENAI_AVAILABLE = True
 except ImportError:
     OPENAI_AVAILABLE = False
@@ -31,6 +44,13 @@ try:
 except ImportError:
     GEMINI_AVAILABLE = False
 
+# Tokenlarni aniq sanash uchun (bo'lmasa taxminiy hisoblanadi)
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
 # Environment variables yuklash
 load_dotenv()
 
@@ -56,11 +76,28 @@ GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', 'AIzaSyC7zcMNz5IbTsuIc9DqwCiucEe43E
 ADMIN_IDS = [int(x.strip()) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip().isdigit()]
 
 # Ma'lumotlar fayllari
-DATA_DIR = 'data'
+DATA_DIR = os.getenv('DATA_DIR', 'data')
 USERS_FILE = os.path.join(DATA_DIR, 'users.json')
 CODES_FILE = os.path.join(DATA_DIR, 'codes.json')
 SETTINGS_FILE = os.path.join(DATA_DIR, 'settings.json')
 CHAT_HISTORY_FILE = os.path.join(DATA_DIR, 'chat_history.json')
+CHAT_LOG_FILE = os.path.join(DATA_DIR, 'chat_history.jsonl')
+MEMBERS_FILE = os.path.join(DATA_DIR, 'members.jsonl')
+
+# Foydalanuvchilar jurnali (o'zgargan foydalanuvchi bitta qator) va har bir foydalanuvchi suhbati alohida faylda
+USERS_LOG_FILE = os.path.join(DATA_DIR, 'users.jsonl')
+CHATS_DIR = os.path.join(DATA_DIR, 'chats')
+
+# Eski bo'laklarga bo'lingan fayllar (ko'chirish uchun)
+USERS_DIR = os.path.join(DATA_DIR, 'users')
+HISTORY_DIR = os.path.join(DATA_DIR, 'history')
+SQLITE_FILE = os.path.join(DATA_DIR, 'bot.db')
+
+# Saqlash turi: json yoki sqlite
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').strip().lower()
+
+# Har bir foydalanuvchi uchun saqlanadigan xabarlar soni
+HISTORY_LIMIT = 20
 
 # ==================== MA'LUMOTLAR BAZASI ====================
 
@@ -71,6 +108,10 @@ def ensure_data_dir():
 
 def load_data(filename: str, default: dict = None) -> dict:
     """JSON fayldan ma'lumot yuklash"""
+    # Hali diskka yozilmagan ma'lumot eng yangisi
+    pending = data_writer.pending(filename)
+    if pending is not None:
+        return pending
     ensure_data_dir()
     if default is None:
         default = {}
@@ -82,14 +123,836 @@ def load_data(filename: str, default: dict = None) -> dict:
         logger.error(f"Fayl yuklashda xatolik: {e}")
     return default
 
+def write_file_atomic(filename: str, text: str) -> bool:
+    """Vaqtinchalik faylga yozib, so'ng almashtirish (muvaffaqiyatli bo'lsa True)"""
+    directory = os.path.dirname(filename) or '.'
+    os.makedirs(directory, exist_ok=True)
+    # Har bir yozuvga alohida vaqtinchalik fayl: parallel yozuvlar bir-birini buzmaydi
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+        return True
+    except Exception as e:
+        logger.error(f"Faylga yozishda xatolik: {e}")
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+        return False
+
+def write_directory_atomic(directory: str, files: Dict[str, str]):
+    """Fayllarni vaqtinchalik papkaga yozib, papkani bir harakatda joylashtirish"""
+    tmp_directory = f"{directory}.tmp"
+    # Oldingi uzilgan urinishning qoldig'i
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    for name, text in files.items():
+        if not write_file_atomic(os.path.join(tmp_directory, name), text):
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            raise RuntimeError(f"{directory} papkasini yozib bo'lmadi")
+    os.replace(tmp_directory, directory)
+
+def append_file(filename: str, text: str):
+    """Fayl oxiriga qo'shish"""
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    try:
+        with open(filename, 'a', encoding='utf-8') as f:
+            f.write(text)
+    except Exception as e:
+        logger.error(f"Faylga yozishda xatolik: {e}")
+
 def save_data(filename: str, data: dict):
     """Ma'lumotlarni JSON faylga saqlash"""
-    ensure_data_dir()
+    data_writer.submit(filename, data)
+
+# Bir faylga yozuvlarni birlashtirish oynasi (soniya)
+WRITE_COALESCE_DELAY = float(os.getenv('WRITE_COALESCE_DELAY', '0.5'))
+
+class DataWriter:
+    """Fon yozuvchisi: bir faylga kelgan yozuvlarni bittaga birlashtiradi"""
+
+    def __init__(self):
+        self._pending: Dict[str, dict] = {}
+        self._inflight: Dict[str, dict] = {}
+        self._appends: Dict[str, List[str]] = {}
+        self._inflight_appends: set = set()
+        self._jobs: List[Callable[[], None]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flushed: Optional[asyncio.Condition] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        # Navbatga qo'yilgan va diskka tushgan yozuvlar hisoblagichlari
+        self._submitted = 0
+        self._durable = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Joriy event loop'da yozuvchini ishga tushirish"""
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._flushed = asyncio.Condition()
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, filename: str, data: dict):
+        """Faylni saqlashga navbat qo'yish (oxirgi holat yoziladi)"""
+        if not self.running:
+            write_file_atomic(filename, json.dumps(data, ensure_ascii=False, indent=2))
+            return
+        self._pending[filename] = data
+        self._submitted += 1
+        self._wakeup.set()
+
+    def append(self, filename: str, text: str):
+        """Fayl oxiriga qo'shishni navbatga qo'yish (tartib saqlanadi)"""
+        if not self.running:
+            append_file(filename, text)
+            return
+        self._appends.setdefault(filename, []).append(text)
+        self._submitted += 1
+        self._wakeup.set()
+
+    def submit_job(self, job: Callable[[], None]):
+        """Ixtiyoriy yozish funksiyasini navbatga qo'yish"""
+        if not self.running:
+            job()
+            return
+        self._jobs.append(job)
+        self._submitted += 1
+        self._wakeup.set()
+
+    def pending(self, filename: str) -> Optional[dict]:
+        """Hali diskka tushmagan ma'lumot"""
+        if filename in self._pending:
+            return self._pending[filename]
+        return self._inflight.get(filename)
+
+    def has_pending(self, filename: str) -> bool:
+        """Faylga hali diskka tushmagan yozuv yoki qo'shimcha bormi"""
+        return (filename in self._pending or filename in self._inflight
+                or filename in self._appends or filename in self._inflight_appends)
+
+    async def wait_for(self, predicate: Callable[[], bool]):
+        """Shart bajarilguncha kutish (har bir yozish to'plamidan keyin tekshiriladi)"""
+        if not self.running or predicate():
+            return
+        async with self._flushed:
+            await self._flushed.wait_for(lambda: predicate() or not self.running)
+
+    async def barrier(self):
+        """Hozirgacha navbatga qo'yilgan barcha yozuvlar diskka tushishini kutish"""
+        if not self.running:
+            return
+        target = self._submitted
+        async with self._flushed:
+            await self._flushed.wait_for(lambda: self._durable >= target or not self.running)
+
+    async def _run(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            if not self._closing:
+                await asyncio.sleep(WRITE_COALESCE_DELAY)
+            self._wakeup.clear()
+            await self.flush()
+        # Yopish sikl boshlanmasdan oldin so'ralgan bo'lsa ham qolganlari yoziladi
+        await self.flush()
+
+    async def flush(self):
+        """Navbatdagi barcha yozuvlarni diskka tushirish"""
+        while self._pending or self._appends or self._jobs:
+            batch = self._submitted
+            self._inflight, self._pending = self._pending, {}
+            appends, self._appends = self._appends, {}
+            self._inflight_appends = set(appends)
+            jobs, self._jobs = self._jobs, []
+            try:
+                for filename, data in self._inflight.items():
+                    # Serializatsiya loop'da: ma'lumot shu paytda o'zgarmaydi
+                    text = json.dumps(data, ensure_ascii=False, indent=2)
+                    await asyncio.to_thread(write_file_atomic, filename, text)
+                for filename, chunks in appends.items():
+                    await asyncio.to_thread(append_file, filename, ''.join(chunks))
+                for job in jobs:
+                    try:
+                        await asyncio.to_thread(job)
+                    except Exception as e:
+                        logger.error(f"Fon yozuvida xatolik: {e}")
+            finally:
+                self._inflight = {}
+                self._inflight_appends = set()
+                self._durable = batch
+                if self._flushed is not None:
+                    async with self._flushed:
+                        self._flushed.notify_all()
+
+    async def close(self):
+        """To'xtatishdan oldin hammasini yozib, yozuvchini to'xtatish"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        async with self._flushed:
+            self._flushed.notify_all()
+
+data_writer = DataWriter()
+
+# ==================== SAQLASH QATLAMI ====================
+
+class Storage(ABC):
+    """Saqlash qatlami interfeysi (JSON yoki SQLite)"""
+
+    @abstractmethod
+    def load_users(self) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_users(self, users: Dict[str, dict], changed: set):
+        raise NotImplementedError
+
+    @abstractmethod
+    def compact_users(self):
+        """Foydalanuvchilar jurnalida har biri uchun faqat oxirgi yozuvni qoldirish"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_codes(self) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_codes(self, codes: Dict[str, dict], changed: set, removed: set):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_settings(self, default: dict) -> dict:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_settings(self, settings: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def settings_version(self):
+        """Sozlamalar tashqaridan o'zgarganini aniqlash uchun belgi"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def iter_history(self):
+        """(user_id, xabarlar) juftliklari"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_history(self, user_id: int) -> List[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def history_pending(self, user_id: int) -> bool:
+        """Foydalanuvchi suhbatiga hali diskka tushmagan yozuvlar bormi"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def append_history(self, user_id: int, entries: List[dict]):
+        raise NotImplementedError
+
+    @abstractmethod
+    def compact_history(self, limit: int):
+        """Har bir foydalanuvchi uchun oxirgi `limit` ta xabarni qoldirish"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_memberships(self) -> Dict[int, Dict[int, bool]]:
+        """Kanal → {user_id: a'zomi}"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_memberships(self, changes: List[tuple]):
+        """(chat_id, user_id, a'zomi) o'zgarishlari; user_id None - kanal indeksini o'chirish"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def compact_memberships(self):
+        """Har bir (kanal, foydalanuvchi) uchun faqat oxirgi holatni qoldirish"""
+        raise NotImplementedError
+
+def chat_file(user_id) -> str:
+    return os.path.join(CHATS_DIR, f"{int(user_id)}.jsonl")
+
+def _read_lines(filename: str) -> List[str]:
+    """Jurnal qatorlari (fayl bo'lmasa bo'sh)"""
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        if os.path.exists(filename):
+            with open(filename, 'r', encoding='utf-8') as f:
+                return f.readlines()
     except Exception as e:
-        logger.error(f"Faylga yozishda xatolik: {e}")
+        logger.error(f"Fayl yuklashda xatolik: {e}")
+    return []
+
+def _parse_lines(lines):
+    """JSON qatorlari (yarim yozilgan oxirgi qator tashlab ketiladi)"""
+    for line in lines:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+def _read_legacy_users():
+    """Jurnaldan oldingi foydalanuvchi fayllari: (manba, foydalanuvchilar)"""
+    if os.path.isdir(USERS_DIR):
+        users: Dict[str, dict] = {}
+        for name in sorted(os.listdir(USERS_DIR)):
+            if name.endswith('.json'):
+                users.update(load_data(os.path.join(USERS_DIR, name), {"users": {}}).get("users", {}))
+        return USERS_DIR, users
+    if os.path.exists(USERS_FILE):
+        return USERS_FILE, load_data(USERS_FILE, {"users": {}}).get("users", {})
+    return None, {}
+
+def _read_legacy_history():
+    """Foydalanuvchi fayllaridan oldingi suhbat fayllari: (manba, [(user_id, xabar)])"""
+    if os.path.isdir(HISTORY_DIR):
+        lines: List[str] = []
+        for name in sorted(os.listdir(HISTORY_DIR)):
+            if name.endswith('.jsonl'):
+                lines.extend(_read_lines(os.path.join(HISTORY_DIR, name)))
+        return HISTORY_DIR, [
+            (record["u"], {"role": record["r"], "content": record["c"]}) for record in _parse_lines(lines)
+        ]
+    if os.path.exists(CHAT_LOG_FILE):
+        return CHAT_LOG_FILE, [
+            (record["u"], {"role": record["r"], "content": record["c"]})
+            for record in _parse_lines(_read_lines(CHAT_LOG_FILE))
+        ]
+    if os.path.exists(CHAT_HISTORY_FILE):
+        legacy = load_data(CHAT_HISTORY_FILE, {"users": {}}).get("users", {})
+        return CHAT_HISTORY_FILE, [(uid, entry) for uid, history in legacy.items() for entry in history]
+    return None, []
+
+class JsonStorage(Storage):
+    """JSON fayllarga saqlash (foydalanuvchilar jurnali, har bir foydalanuvchi suhbati alohida fayl)"""
+
+    def __init__(self):
+        self._user_lines = 0
+        self._user_count = 0
+        self._dirty_chats: set = set()
+        self._history_migrated = False
+        self._migrate_lock = threading.Lock()
+
+    def _migrate_legacy_users(self):
+        """Eski users.json yoki bo'laklarni jurnalga ko'chirish"""
+        if os.path.exists(USERS_LOG_FILE):
+            return
+        source, users = _read_legacy_users()
+        if source is None:
+            return
+        # Jurnal bir harakatda paydo bo'ladi, eski fayllar undan keyin
+        if not write_file_atomic(USERS_LOG_FILE, ''.join(_user_line(uid, user) for uid, user in users.items())):
+            raise RuntimeError("Foydalanuvchilar jurnalini yozib bo'lmadi")
+        os.replace(source, f"{source}.migrated")
+
+    def load_users(self) -> Dict[str, dict]:
+        self._migrate_legacy_users()
+        users: Dict[str, dict] = {}
+        lines = _read_lines(USERS_LOG_FILE)
+        for record in _parse_lines(lines):
+            users[str(record["i"])] = record["d"]
+        self._user_lines = len(lines)
+        self._user_count = len(users)
+        return users
+
+    def save_users(self, users: Dict[str, dict], changed: set):
+        # Faqat o'zgargan foydalanuvchilar yoziladi: yozuv hajmi foydalanuvchilar soniga bog'liq emas
+        lines = [_user_line(uid, users[uid]) for uid in changed if uid in users]
+        self._user_lines += len(lines)
+        self._user_count = len(users)
+        data_writer.append(USERS_LOG_FILE, ''.join(lines))
+
+    def compact_users(self):
+        # Jurnal foydalanuvchilar sonidan ikki barobar oshganda qayta yoziladi
+        if self._user_lines <= 2 * self._user_count:
+            return
+
+        def compact():
+            # Fayldan o'qiladi: navbatdagi qo'shimchalar ham hisobga olinadi
+            users: Dict[str, dict] = {}
+            for record in _parse_lines(_read_lines(USERS_LOG_FILE)):
+                users[str(record["i"])] = record["d"]
+            write_file_atomic(USERS_LOG_FILE, ''.join(_user_line(uid, user) for uid, user in users.items()))
+
+        self._user_lines = self._user_count
+        data_writer.submit_job(compact)
+
+    def load_codes(self) -> Dict[str, dict]:
+        return load_data(CODES_FILE, {"codes": {}}).get("codes", {})
+
+    def save_codes(self, codes: Dict[str, dict], changed: set, removed: set):
+        save_data(CODES_FILE, {"codes": codes})
+
+    def load_settings(self, default: dict) -> dict:
+        return load_data(SETTINGS_FILE, default)
+
+    def save_settings(self, settings: dict):
+        save_data(SETTINGS_FILE, settings)
+
+    def settings_version(self):
+        try:
+            return os.stat(SETTINGS_FILE).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read_chat(self, user_id) -> List[dict]:
+        """Foydalanuvchi suhbati jurnali"""
+        self._migrate_legacy_history()
+        return [
+            {"role": record["r"], "content": record["c"]}
+            for record in _parse_lines(_read_lines(chat_file(user_id)))
+        ]
+
+    def _migrate_legacy_history(self):
+        """Eski suhbat fayllarini foydalanuvchi fayllariga ajratish"""
+        with self._migrate_lock:
+            if not self._history_migrated:
+                self._split_legacy_history()
+                self._history_migrated = True
+
+    def _split_legacy_history(self):
+        if os.path.exists(CHATS_DIR):
+            return
+        source, records = _read_legacy_history()
+        if source is None:
+            os.makedirs(CHATS_DIR, exist_ok=True)
+            return
+        chats: Dict[str, List[str]] = {}
+        for uid, entry in records:
+            chats.setdefault(str(uid), []).append(_history_line(uid, entry))
+        # Papka faqat barcha fayllar yozilgach paydo bo'ladi, eski fayllar undan keyin
+        write_directory_atomic(CHATS_DIR, {
+            os.path.basename(chat_file(uid)): ''.join(lines[-HISTORY_LIMIT:])
+            for uid, lines in chats.items()
+        })
+        os.replace(source, f"{source}.migrated")
+
+    def iter_history(self):
+        self._migrate_legacy_history()
+        for name in sorted(os.listdir(CHATS_DIR)):
+            if name.endswith('.jsonl'):
+                uid = name[:-len('.jsonl')]
+                yield uid, self._read_chat(uid)[-HISTORY_LIMIT:]
+
+    def load_history(self, user_id: int) -> List[dict]:
+        # Faqat shu foydalanuvchining fayli o'qiladi
+        return self._read_chat(user_id)[-HISTORY_LIMIT:]
+
+    def history_pending(self, user_id: int) -> bool:
+        return data_writer.has_pending(chat_file(user_id))
+
+    def append_history(self, user_id: int, entries: List[dict]):
+        self._dirty_chats.add(int(user_id))
+        data_writer.append(chat_file(user_id), ''.join(_history_line(user_id, e) for e in entries))
+
+    def compact_history(self, limit: int):
+        users, self._dirty_chats = self._dirty_chats, set()
+
+        def compact():
+            for user_id in users:
+                entries = self._read_chat(user_id)
+                if len(entries) > limit:
+                    write_file_atomic(chat_file(user_id), ''.join(
+                        _history_line(user_id, entry) for entry in entries[-limit:]
+                    ))
+
+        data_writer.submit_job(compact)
+
+    def load_memberships(self) -> Dict[int, Dict[int, bool]]:
+        memberships: Dict[int, Dict[int, bool]] = {}
+        try:
+            if os.path.exists(MEMBERS_FILE):
+                with open(MEMBERS_FILE, 'r', encoding='utf-8') as f:
+                    lines = f.readlines()
+            else:
+                lines = []
+        except Exception as e:
+            logger.error(f"Fayl yuklashda xatolik: {e}")
+            lines = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Yarim yozilgan oxirgi qator
+                continue
+            if record["u"] is None:
+                memberships.pop(record["c"], None)
+            else:
+                memberships.setdefault(record["c"], {})[record["u"]] = record["m"]
+        return memberships
+
+    def save_memberships(self, changes: List[tuple]):
+        data_writer.append(MEMBERS_FILE, ''.join(
+            _membership_line(chat_id, user_id, is_member) for chat_id, user_id, is_member in changes
+        ))
+
+    def compact_memberships(self):
+        def compact():
+            # Fayldan o'qiladi: navbatdagi qo'shimchalar ham hisobga olinadi
+            memberships = self.load_memberships()
+            write_file_atomic(MEMBERS_FILE, ''.join(
+                _membership_line(chat_id, user_id, is_member)
+                for chat_id, members in memberships.items()
+                for user_id, is_member in members.items()
+            ))
+
+        data_writer.submit_job(compact)
+
+class SqliteStorage(Storage):
+    """SQLite (WAL rejimi) ga saqlash"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            last_active TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active);
+
+        CREATE TABLE IF NOT EXISTS codes (
+            code TEXT PRIMARY KEY,
+            user_id INTEGER,
+            expires_at TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_codes_expires_at ON codes(expires_at);
+
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS chat_history (
+            user_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            PRIMARY KEY (user_id, seq)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS channel_members (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            is_member INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID;
+    """
+
+    # Sxema versiyasi (PRAGMA user_version): undan kichik bo'lsa baza hali tayyorlanmagan
+    SCHEMA_VERSION = 1
+
+    def __init__(self, filename: str, auto_migrate: bool = True):
+        self.filename = filename
+        self.auto_migrate = auto_migrate
+        self._conn = None
+        self._lock = threading.Lock()
+        # O'qish uchun alohida ulanish: WAL'da yozuvchi tranzaksiyasini kutmaydi
+        self._read_conn = None
+        self._read_lock = threading.Lock()
+        # Navbatdagi suhbat yozuvlari soni (foydalanuvchi bo'yicha)
+        self._pending_history: Dict[int, int] = {}
+        self._pending_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Ulanishni birinchi murojaatda ochish"""
+        if self._conn is None:
+            ensure_data_dir()
+            conn = sqlite3.connect(self.filename, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+                self._initialize(conn)
+            self._conn = conn
+        return self._conn
+
+    def _initialize(self, conn: sqlite3.Connection):
+        """Sxema va JSON dan ko'chirish bitta tranzaksiyada; tugaganini user_version belgilaydi"""
+        # Belgi qo'shilishidan oldin yaratilgan bazada ko'chirish allaqachon bajarilgan
+        existing = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone()
+        data, sources = read_json_sources() if self.auto_migrate and not existing else (None, [])
+        try:
+            conn.execute("BEGIN")
+            for statement in self.SCHEMA.split(';'):
+                if statement.strip():
+                    conn.execute(statement)
+            if data is not None:
+                import_json_data(conn, data)
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            conn.close()
+            raise
+        # Eski fayllar faqat ma'lumotlar bazaga tushgach chetga olinadi
+        retire_json_sources(sources)
+
+    def _reader(self) -> sqlite3.Connection:
+        """O'qish ulanishini birinchi murojaatda ochish (sxema yozish ulanishida yaratiladi)"""
+        if self._read_conn is None:
+            with self._lock:
+                self._connect()
+            conn = sqlite3.connect(self.filename, check_same_thread=False)
+            conn.execute("PRAGMA query_only=ON")
+            self._read_conn = conn
+        return self._read_conn
+
+    def _execute(self, sql: str, params=()) -> list:
+        """O'qish so'rovi (fon yozuvchisining qulfini kutmaydi)"""
+        with self._read_lock:
+            return self._reader().execute(sql, params).fetchall()
+
+    def _transaction(self, fn: Callable[[sqlite3.Connection], None]):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                fn(conn)
+
+    def _write(self, fn: Callable[[sqlite3.Connection], None]):
+        """Yozuvni fon yozuvchisi orqali bajarish"""
+        data_writer.submit_job(lambda: self._transaction(fn))
+
+    def load_users(self) -> Dict[str, dict]:
+        rows = self._execute("SELECT user_id, data FROM users")
+        return {str(user_id): json.loads(data) for user_id, data in rows}
+
+    def save_users(self, users: Dict[str, dict], changed: set):
+        rows = [
+            (int(uid), users[uid].get("last_active"), json.dumps(users[uid], ensure_ascii=False))
+            for uid in changed if uid in users
+        ]
+        self._write(lambda conn: conn.executemany(
+            "INSERT INTO users (user_id, last_active, data) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET last_active = excluded.last_active, data = excluded.data",
+            rows
+        ))
+
+    def compact_users(self):
+        # Jadvalda har bir foydalanuvchi uchun bitta qator: siqish shart emas
+        pass
+
+    def load_codes(self) -> Dict[str, dict]:
+        rows = self._execute("SELECT code, data FROM codes")
+        return {code: json.loads(data) for code, data in rows}
+
+    def save_codes(self, codes: Dict[str, dict], changed: set, removed: set):
+        deleted = [(code,) for code in removed]
+        rows = [
+            (code, codes[code].get("user_id"), codes[code]["expires_at"], json.dumps(codes[code], ensure_ascii=False))
+            for code in changed if code in codes
+        ]
+
+        def write(conn: sqlite3.Connection):
+            conn.executemany("DELETE FROM codes WHERE code = ?", deleted)
+            conn.executemany(
+                "INSERT OR REPLACE INTO codes (code, user_id, expires_at, data) VALUES (?, ?, ?, ?)",
+                rows
+            )
+
+        self._write(write)
+
+    def load_settings(self, default: dict) -> dict:
+        rows = self._execute("SELECT key, value FROM settings")
+        if not rows:
+            return default
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_settings(self, settings: dict):
+        rows = [(key, json.dumps(value, ensure_ascii=False)) for key, value in settings.items()]
+
+        def write(conn: sqlite3.Connection):
+            conn.execute("DELETE FROM settings")
+            conn.executemany("INSERT INTO settings (key, value) VALUES (?, ?)", rows)
+
+        self._write(write)
+
+    def settings_version(self):
+        # Boshqa ulanishlar (yozish ulanishi yoki sqlite3 konsol) yozganda o'zgaradi
+        return self._execute("PRAGMA data_version")[0][0]
+
+    def iter_history(self):
+        rows = self._execute("SELECT user_id, role, content FROM chat_history ORDER BY user_id, seq")
+        tails: Dict[str, deque] = {}
+        for user_id, role, content in rows:
+            tails.setdefault(str(user_id), deque(maxlen=HISTORY_LIMIT)).append({"role": role, "content": content})
+        for uid, tail in tails.items():
+            yield uid, list(tail)
+
+    def load_history(self, user_id: int) -> List[dict]:
+        rows = self._execute(
+            "SELECT role, content FROM chat_history WHERE user_id = ? ORDER BY seq DESC LIMIT ?",
+            (user_id, HISTORY_LIMIT)
+        )
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def history_pending(self, user_id: int) -> bool:
+        return user_id in self._pending_history
+
+    def append_history(self, user_id: int, entries: List[dict]):
+        entries = [(e["role"], e["content"]) for e in entries]
+
+        def write(conn: sqlite3.Connection):
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM chat_history WHERE user_id = ?", (user_id,)
+            ).fetchone()[0]
+            conn.executemany(
+                "INSERT INTO chat_history (user_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(user_id, seq + i, role, content) for i, (role, content) in enumerate(entries, 1)]
+            )
+
+        def job():
+            try:
+                self._transaction(write)
+            finally:
+                with self._pending_lock:
+                    left = self._pending_history.pop(user_id) - 1
+                    if left:
+                        self._pending_history[user_id] = left
+
+        with self._pending_lock:
+            self._pending_history[user_id] = self._pending_history.get(user_id, 0) + 1
+        data_writer.submit_job(job)
+
+    def compact_history(self, limit: int):
+        self._write(lambda conn: conn.execute(
+            "DELETE FROM chat_history WHERE seq <= "
+            "(SELECT MAX(h.seq) FROM chat_history h WHERE h.user_id = chat_history.user_id) - ?",
+            (limit,)
+        ))
+
+    def load_memberships(self) -> Dict[int, Dict[int, bool]]:
+        memberships: Dict[int, Dict[int, bool]] = {}
+        for chat_id, user_id, is_member in self._execute("SELECT chat_id, user_id, is_member FROM channel_members"):
+            memberships.setdefault(chat_id, {})[user_id] = bool(is_member)
+        return memberships
+
+    def save_memberships(self, changes: List[tuple]):
+        def write(conn: sqlite3.Connection):
+            for chat_id, user_id, is_member in changes:
+                if user_id is None:
+                    conn.execute("DELETE FROM channel_members WHERE chat_id = ?", (chat_id,))
+                else:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO channel_members (chat_id, user_id, is_member) VALUES (?, ?, ?)",
+                        (chat_id, user_id, int(is_member))
+                    )
+
+        self._write(write)
+
+    def compact_memberships(self):
+        # Jadvalda har bir juftlik uchun bitta qator: siqish shart emas
+        pass
+
+def _history_line(user_id, entry: dict) -> str:
+    """Suhbat jurnalining bitta qatori"""
+    return json.dumps(
+        {"u": int(user_id), "r": entry["role"], "c": entry["content"]},
+        ensure_ascii=False
+    ) + "\n"
+
+def _user_line(user_id, user: dict) -> str:
+    """Foydalanuvchilar jurnalining bitta qatori"""
+    return json.dumps({"i": int(user_id), "d": user}, ensure_ascii=False) + "\n"
+
+def _membership_line(chat_id, user_id, is_member) -> str:
+    """A'zolik jurnalining bitta qatori"""
+    return json.dumps({"c": chat_id, "u": user_id, "m": is_member}) + "\n"
+
+def read_json_sources():
+    """JSON ma'lumotlarni hech narsani o'zgartirmasdan o'qish: (ma'lumotlar, ko'chirilgach eskiradigan fayllar)"""
+    json_storage = JsonStorage()
+    sources: List[str] = []
+    # Joriy jurnal va papka bor bo'lsa JsonStorage ularni o'zgartirmasdan o'qiydi
+    if os.path.exists(USERS_LOG_FILE):
+        users = json_storage.load_users()
+    else:
+        source, users = _read_legacy_users()
+        sources += [source] if source else []
+    if os.path.exists(CHATS_DIR):
+        chat_history = dict(json_storage.iter_history())
+    else:
+        source, records = _read_legacy_history()
+        sources += [source] if source else []
+        chat_history: Dict[str, List[dict]] = {}
+        for uid, entry in records:
+            chat_history.setdefault(str(uid), []).append(entry)
+        chat_history = {uid: history[-HISTORY_LIMIT:] for uid, history in chat_history.items()}
+    data = {
+        "users": users,
+        "codes": load_data(CODES_FILE, {"codes": {}}).get("codes", {}),
+        "settings": load_data(SETTINGS_FILE, {}),
+        "chat_history": chat_history,
+        "memberships": json_storage.load_memberships(),
+    }
+    return data, sources
+
+def retire_json_sources(sources: List[str]):
+    """Bazaga ko'chirilgan eski fayllarni .migrated nomi bilan chetga olish"""
+    for source in sources:
+        os.replace(source, f"{source}.migrated")
+
+def import_json_data(conn: sqlite3.Connection, data: dict):
+    """JSON ma'lumotlarni joriy tranzaksiyada jadvallarga yozish"""
+    users, codes, settings = data["users"], data["codes"], data["settings"]
+    chat_history, memberships = data["chat_history"], data["memberships"]
+    conn.executemany(
+        "INSERT OR REPLACE INTO users (user_id, last_active, data) VALUES (?, ?, ?)",
+        [(int(uid), u.get("last_active"), json.dumps(u, ensure_ascii=False)) for uid, u in users.items()]
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO codes (code, user_id, expires_at, data) VALUES (?, ?, ?, ?)",
+        [(code, c.get("user_id"), c["expires_at"], json.dumps(c, ensure_ascii=False)) for code, c in codes.items()]
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+        [(key, json.dumps(value, ensure_ascii=False)) for key, value in settings.items()]
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO chat_history (user_id, seq, role, content) VALUES (?, ?, ?, ?)",
+        [
+            (int(uid), seq, e["role"], e["content"])
+            for uid, history in chat_history.items()
+            for seq, e in enumerate(history, 1)
+        ]
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO channel_members (chat_id, user_id, is_member) VALUES (?, ?, ?)",
+        [
+            (chat_id, user_id, int(is_member))
+            for chat_id, members in memberships.items()
+            for user_id, is_member in members.items()
+        ]
+    )
+    logger.info(
+        f"✅ JSON → SQLite: {len(users)} foydalanuvchi, {len(codes)} kod, "
+        f"{len(chat_history)} suhbat ko'chirildi"
+    )
+
+def migrate_json_to_sqlite(target: SqliteStorage):
+    """Mavjud JSON fayllarni tayyor SQLite bazaga qo'lda ko'chirish"""
+    data, sources = read_json_sources()
+    conn = target._connect()
+    with target._lock, conn:
+        import_json_data(conn, data)
+    retire_json_sources(sources)
+
+def create_storage() -> Storage:
+    """Sozlamaga ko'ra saqlash qatlamini tanlash"""
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStorage(SQLITE_FILE)
+    return JsonStorage()
+
+storage = create_storage()
 
 # ==================== SOZLAMALAR ====================
 
@@ -99,116 +962,568 @@ DEFAULT_SETTINGS = {
     "code_expiry_minutes": 10,  # Kod amal qilish muddati (daqiqa)
     "ai_enabled": True,
     "ai_provider": "gemini",  # gemini yoki openai
-    "ai_system_prompt": "Siz IELTS imtihoniga tayyorlanish bo'yicha professional yordamchisiz. Foydalanuvchilarga IELTS bo'yicha yordam bering."
+    "ai_system_prompt": "Siz IELTS imtihoniga tayyorlanish bo'yicha professional yordamchisiz. Foydalanuvchilarga IELTS bo'yicha yordam bering.",
+    # So'rovlar cheklovi: [so'rovlar soni, soniya] - foydalanuvchi va butun bot uchun
+    "rate_limits": {
+        "update": {"user": [30, 60]},
+        "ai": {"user": [10, 60], "global": [120, 60]},
+        "code": {"user": [3, 300], "global": [60, 60]}
+    },
+    # Kanal a'zoligi natijasini eslab qolish muddati (soniya)
+    "subscription_cache": {"member_ttl": 600, "nonmember_ttl": 30},
+    # Kanalni tekshirib bo'lmaganda: "allow" - o'tkazish, "deny" - obuna so'rash
+    "subscription_error_policy": "allow"
 }
 
-def get_settings() -> dict:
+# Sozlamalar fayli qo'lda o'zgarganini tekshirish oralig'i (soniya)
+SETTINGS_RECHECK_INTERVAL = float(os.getenv('SETTINGS_RECHECK_INTERVAL', '5'))
+
+def _freeze(value):
+    """O'zgartirib bo'lmaydigan nusxa (dict → MappingProxyType, list → tuple)"""
+    if isinstance(value, (dict, MappingProxyType)):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def _thaw(value):
+    """Muzlatilgan nusxadan oddiy dict/list yaratish"""
+    if isinstance(value, (dict, MappingProxyType)):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_thaw(v) for v in value]
+    return value
+
+class SettingsCache:
+    """Jarayon bo'yicha yagona sozlamalar nusxasi"""
+
+    def __init__(self, backend: Storage):
+        self.backend = backend
+        self._snapshot: Optional[Mapping] = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self) -> Mapping:
+        """Joriy sozlamalar (o'zgartirib bo'lmaydi)"""
+        now = time.monotonic()
+        if self._snapshot is None or now - self._checked_at >= SETTINGS_RECHECK_INTERVAL:
+            self._checked_at = now
+            version = self.backend.settings_version()
+            if self._snapshot is None or version != self._version:
+                self._version = version
+                self._snapshot = _freeze(self.backend.load_settings(DEFAULT_SETTINGS))
+        return self._snapshot
+
+    def save(self, settings: dict):
+        """Saqlash va nusxani yangilash"""
+        self.backend.save_settings(settings)
+        self._snapshot = _freeze(settings)
+        self._version = self.backend.settings_version()
+        self._checked_at = time.monotonic()
+
+settings_cache = SettingsCache(storage)
+
+def get_settings() -> Mapping:
     """Sozlamalarni olish"""
-    return load_data(SETTINGS_FILE, DEFAULT_SETTINGS)
+    return settings_cache.get()
+
+def get_settings_copy() -> dict:
+    """Sozlamalarning o'zgartirish mumkin bo'lgan nusxasi"""
+    return _thaw(settings_cache.get())
 
 def save_settings(settings: dict):
     """Sozlamalarni saqlash"""
-    save_data(SETTINGS_FILE, settings)
+    settings_cache.save(settings)
 
 # ==================== FOYDALANUVCHILAR ====================
 
+# Xotiradagi foydalanuvchilarni diskka yozish oralig'i (soniya)
+USERS_FLUSH_INTERVAL = int(os.getenv('USERS_FLUSH_INTERVAL', '5'))
+
+class UserStore:
+    """Foydalanuvchilar ombori: bir marta yuklanadi, o'zgarganlari diskka yoziladi"""
+
+    def __init__(self, backend: Storage):
+        self.backend = backend
+        self._users: Dict[str, dict] = {}
+        self._dirty: set = set()
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        """Fayldan faqat birinchi murojaatda yuklash"""
+        if not self._loaded:
+            self._users = self.backend.load_users()
+            self._loaded = True
+
+    def preload(self):
+        """Ishga tushishda oldindan yuklash"""
+        self._ensure_loaded()
+
+    def get(self, user_id: int) -> Optional[dict]:
+        """Bitta foydalanuvchi (nusxa)"""
+        self._ensure_loaded()
+        user = self._users.get(str(user_id))
+        return dict(user) if user is not None else None
+
+    def put(self, user_id: int, user_data: dict):
+        """Foydalanuvchini yangilash va o'zgargan deb belgilash"""
+        self._ensure_loaded()
+        self._users[str(user_id)] = user_data
+        self._dirty.add(str(user_id))
+
+    def replace_all(self, users: Dict[str, dict]):
+        """Barcha foydalanuvchilarni almashtirish"""
+        self._loaded = True
+        self._users = dict(users)
+        self._dirty.update(self._users.keys())
+
+    def all(self) -> Dict[str, dict]:
+        """Barcha foydalanuvchilar (faqat o'qish uchun)"""
+        self._ensure_loaded()
+        return self._users
+
+    def ids(self) -> List[str]:
+        """Foydalanuvchi ID lari (yuborish paytida ro'yxat o'zgarsa ham xavfsiz)"""
+        self._ensure_loaded()
+        return list(self._users)
+
+    def active_ids(self) -> List[int]:
+        """Xabar yetkazish mumkin bo'lgan foydalanuvchilar (botni bloklamaganlar)"""
+        self._ensure_loaded()
+        return [int(uid) for uid, user in self._users.items() if user.get("active", True)]
+
+    def mark_inactive(self, user_id: int, reason: str):
+        """Xabar yetkazib bo'lmaydi: keyingi tarqatishlarda o'tkazib yuboriladi"""
+        self._ensure_loaded()
+        user = self._users.get(str(user_id))
+        if user is None or not user.get("active", True):
+            return
+        self.put(user_id, dict(user, active=False, inactive_reason=reason))
+
+    def recent(self, limit: int) -> List[dict]:
+        """Oxirgi faol foydalanuvchilar (yangisi birinchi)"""
+        self._ensure_loaded()
+        return heapq.nlargest(limit, self._users.values(), key=lambda u: u.get("last_active") or "")
+
+    def count(self) -> int:
+        """Foydalanuvchilar soni"""
+        self._ensure_loaded()
+        return len(self._users)
+
+    def flush(self):
+        """O'zgarishlar bo'lsa diskka yozish"""
+        if not self._dirty:
+            return
+        self.backend.save_users(self._users, self._dirty)
+        self._dirty.clear()
+
+    def compact(self):
+        """Jurnalni siqish (o'zgarishlar diskka tushgach)"""
+        self.flush()
+        self.backend.compact_users()
+
+user_store = UserStore(storage)
+
+
 def get_users() -> dict:
     """Foydalanuvchilarni olish"""
-    return load_data(USERS_FILE, {"users": {}})
+    return {"users": user_store.all()}
 
 def save_users(users: dict):
     """Foydalanuvchilarni saqlash"""
-    save_data(USERS_FILE, users)
+    user_store.replace_all(users.get("users", {}))
+    user_store.flush()
 
 def get_user(user_id: int) -> Optional[dict]:
     """Bitta foydalanuvchini olish"""
-    users = get_users()
-    return users["users"].get(str(user_id))
+    return user_store.get(user_id)
 
 def save_user(user_id: int, user_data: dict):
     """Foydalanuvchini saqlash"""
-    users = get_users()
-    users["users"][str(user_id)] = user_data
-    save_users(users)
+    user_store.put(user_id, user_data)
 
 def is_user_registered(user_id: int) -> bool:
     """Foydalanuvchi ro'yxatdan o'tganmi"""
-    user = get_user(user_id)
+    user = user_store.get(user_id)
     return user is not None and user.get("verified", False)
 
 # ==================== KODLAR TIZIMI ====================
 
+# 6 xonali kodlar soni
+CODE_SPACE = 10 ** 6
+
+# Eskirgan kodlarni tozalash oralig'i (soniya)
+CODE_SWEEP_INTERVAL = int(os.getenv('CODE_SWEEP_INTERVAL', '60'))
+
+class CodeTable:
+    """Kodlar jadvali: xotirada, muddati bo'yicha min-heap bilan"""
+
+    def __init__(self, backend: Storage):
+        self.backend = backend
+        self._codes: Dict[str, dict] = {}
+        self._expiry: Dict[str, float] = {}
+        self._by_user: Dict[int, str] = {}
+        self._heap: List[tuple] = []
+        self._used_count = 0
+        self._changed: set = set()
+        self._removed: set = set()
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        """Saqlangan kodlarni faqat birinchi murojaatda yuklash"""
+        if self._loaded:
+            return
+        self._loaded = True
+        for code, code_data in self.backend.load_codes().items():
+            self._add(code, code_data)
+
+    def preload(self):
+        """Ishga tushishda oldindan yuklash"""
+        self._ensure_loaded()
+
+    def _add(self, code: str, code_data: dict):
+        expires_ts = datetime.fromisoformat(code_data["expires_at"]).timestamp()
+        self._codes[code] = code_data
+        self._expiry[code] = expires_ts
+        heapq.heappush(self._heap, (expires_ts, code))
+        if code_data.get("used"):
+            self._used_count += 1
+        else:
+            self._by_user[code_data.get("user_id")] = code
+
+    def _remove(self, code: str):
+        code_data = self._codes.pop(code)
+        del self._expiry[code]
+        if code_data.get("used"):
+            self._used_count -= 1
+        elif self._by_user.get(code_data.get("user_id")) == code:
+            del self._by_user[code_data.get("user_id")]
+        self._changed.discard(code)
+        self._removed.add(code)
+
+    def _allocate(self) -> str:
+        """Band bo'lmagan tasodifiy kod tanlash"""
+        if len(self._codes) >= CODE_SPACE * 0.9:
+            self.sweep()
+            if len(self._codes) >= CODE_SPACE * 0.9:
+                raise RuntimeError("Bo'sh kodlar qolmadi")
+        while True:
+            code = f"{secrets.randbelow(CODE_SPACE):06d}"
+            if code not in self._codes:
+                return code
+
+    def issue(self, user_id: int, telegram_username: str, expiry_minutes: int) -> str:
+        """Yangi kod berish (foydalanuvchining oldingi kodi bekor qilinadi)"""
+        self._ensure_loaded()
+        previous = self._by_user.get(user_id)
+        if previous is not None:
+            self._remove(previous)
+
+        code = self._allocate()
+        now = datetime.now()
+        self._add(code, {
+            "user_id": user_id,
+            "telegram_username": telegram_username,
+            "created_at": now.isoformat(),
+            "expires_at": (now + timedelta(minutes=expiry_minutes)).isoformat(),
+            "used": False
+        })
+        self._removed.discard(code)
+        self._changed.add(code)
+        return code
+
+    def verify(self, code: str) -> Optional[dict]:
+        """Kodni tekshirish va ishlatilgan deb belgilash"""
+        self._ensure_loaded()
+        code_data = self._codes.get(code)
+        if code_data is None or code_data["used"]:
+            return None
+        if time.time() > self._expiry[code]:
+            return None
+
+        code_data["used"] = True
+        code_data["used_at"] = datetime.now().isoformat()
+        self._used_count += 1
+        if self._by_user.get(code_data.get("user_id")) == code:
+            del self._by_user[code_data.get("user_id")]
+        self._changed.add(code)
+        return code_data
+
+    def sweep(self) -> int:
+        """Muddati o'tgan kodlarni heap boshidan olib tashlash"""
+        self._ensure_loaded()
+        now = time.time()
+        removed = 0
+        while self._heap and self._heap[0][0] < now:
+            expires_ts, code = heapq.heappop(self._heap)
+            # Bekor qilingan yoki qayta berilgan kodlarning eski yozuvlari
+            if self._expiry.get(code) != expires_ts:
+                continue
+            self._remove(code)
+            removed += 1
+        return removed
+
+    def all(self) -> Dict[str, dict]:
+        """Barcha kodlar (faqat o'qish uchun)"""
+        self._ensure_loaded()
+        return self._codes
+
+    def stats(self) -> tuple:
+        """(jami, ishlatilgan) kodlar soni"""
+        self._ensure_loaded()
+        return len(self._codes), self._used_count
+
+    def flush(self):
+        """O'zgarishlar bo'lsa diskka yozish"""
+        if not self._changed and not self._removed:
+            return
+        self.backend.save_codes(self._codes, self._changed, self._removed)
+        self._changed = set()
+        self._removed = set()
+
+code_table = CodeTable(storage)
+
+def flush_all():
+    """Xotiradagi barcha o'zgarishlarni diskka yozish"""
+    user_store.flush()
+    code_table.flush()
+    answer_cache.flush()
+
+async def preload_stores():
+    """Omborlarni update'lar kelishidan oldin fonda yuklash (handler diskni kutmaydi)"""
+    await asyncio.gather(
+        asyncio.to_thread(settings_cache.get),
+        asyncio.to_thread(user_store.preload),
+        asyncio.to_thread(code_table.preload),
+        asyncio.to_thread(answer_cache.preload),
+        asyncio.to_thread(membership_index.preload),
+    )
+
+async def periodic_flush():
+    """Xotiradagi o'zgarishlarni vaqti-vaqti bilan diskka yozish"""
+    while True:
+        await asyncio.sleep(USERS_FLUSH_INTERVAL)
+        flush_all()
+
+async def code_sweeper():
+    """Eskirgan kodlarni vaqti-vaqti bilan tozalash"""
+    while True:
+        await asyncio.sleep(CODE_SWEEP_INTERVAL)
+        removed = code_table.sweep()
+        if removed:
+            logger.info(f"🧹 {removed} ta eskirgan kod tozalandi")
+
 def get_codes() -> dict:
     """Kodlarni olish"""
-    return load_data(CODES_FILE, {"codes": {}})
-
-def save_codes(codes: dict):
-    """Kodlarni saqlash"""
-    save_data(CODES_FILE, codes)
+    return {"codes": code_table.all()}
 
 def generate_code(user_id: int, telegram_username: str = None) -> str:
     """Yangi 6 ta raqamli kod yaratish"""
     settings = get_settings()
-    codes = get_codes()
-    
-    # 6 ta raqamli kod yaratish
-    code = ''.join(random.choices(string.digits, k=6))
-    
-    # Amal qilish muddati
-    expiry = datetime.now() + timedelta(minutes=settings.get("code_expiry_minutes", 10))
-    
-    codes["codes"][code] = {
-        "user_id": user_id,
-        "telegram_username": telegram_username,
-        "created_at": datetime.now().isoformat(),
-        "expires_at": expiry.isoformat(),
-        "used": False
-    }
-    
-    save_codes(codes)
+    code = code_table.issue(user_id, telegram_username, settings.get("code_expiry_minutes", 10))
+    # Kod saytda darhol kiritiladi: davriy yozishni kutmasdan yozuvchiga beriladi
+    code_table.flush()
     logger.info(f"Yangi kod yaratildi: {code} - User: {user_id}")
     return code
 
 def verify_code(code: str) -> Optional[dict]:
     """Kodni tekshirish"""
-    codes = get_codes()
-    
-    if code not in codes["codes"]:
-        return None
-    
-    code_data = codes["codes"][code]
-    
-    # Vaqti o'tganmi tekshirish
-    expiry = datetime.fromisoformat(code_data["expires_at"])
-    if datetime.now() > expiry:
-        return None
-    
-    # Ishlatilganmi tekshirish
-    if code_data["used"]:
-        return None
-    
-    # Kodni ishlatilgan deb belgilash
-    codes["codes"][code]["used"] = True
-    codes["codes"][code]["used_at"] = datetime.now().isoformat()
-    save_codes(codes)
-    
+    code_data = code_table.verify(code)
+    if code_data is not None:
+        # Ishlatilgan kod qayta ishga tushgandan keyin ham ishlatilgan bo'lib qoladi
+        code_table.flush()
     return code_data
 
 def cleanup_expired_codes():
     """Eskirgan kodlarni tozalash"""
-    codes = get_codes()
-    now = datetime.now()
-    
-    to_delete = []
-    for code, data in codes["codes"].items():
-        expiry = datetime.fromisoformat(data["expires_at"])
-        if now > expiry:
-            to_delete.append(code)
-    
-    for code in to_delete:
-        del codes["codes"][code]
-    
-    save_codes(codes)
+    code_table.sweep()
+    code_table.flush()
+
+# ==================== SUHBAT TARIXI ====================
+
+# Suhbat jurnalini siqish oralig'i (soniya)
+HISTORY_COMPACT_INTERVAL = int(os.getenv('HISTORY_COMPACT_INTERVAL', '600'))
+
+# Suhbat keshi uchun xotira chegarasi (bayt)
+HISTORY_CACHE_BYTES = int(os.getenv('HISTORY_CACHE_BYTES', str(32 * 1024 * 1024)))
+
+# Promptga kiradigan suhbat tarixi va eski xabarlar qisqacha mazmuni uchun token chegaralari
+AI_HISTORY_TOKENS = int(os.getenv('AI_HISTORY_TOKENS', '1500'))
+AI_SUMMARY_TOKENS = int(os.getenv('AI_SUMMARY_TOKENS', '300'))
+
+# Har bir xabar uchun qo'shimcha tokenlar (rol, ajratgichlar)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+# Qisqacha mazmunda bitta xabardan olinadigan belgilar soni
+GIST_CHARS = 160
+
+_token_encoding = None
+
+def count_tokens(text: str) -> int:
+    """Matndagi tokenlar soni (tiktoken bo'lmasa ~4 belgi = 1 token)"""
+    global _token_encoding
+    if TIKTOKEN_AVAILABLE and _token_encoding is None:
+        try:
+            # gpt-4o oilasi kodlashi
+            _token_encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _token_encoding = False
+    if _token_encoding:
+        return len(_token_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+class Turn:
+    """Suhbatdagi bitta xabar (ixcham ko'rinishda)"""
+
+    __slots__ = ('role', 'content', 'tokens')
+
+    def __init__(self, role: str, content: str):
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = count_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+
+    def as_dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+# Turn obyekti va deque elementi uchun taxminiy qo'shimcha xotira
+TURN_OVERHEAD = sys.getsizeof(Turn("user", "")) - sys.getsizeof("") + 8
+USER_OVERHEAD = sys.getsizeof(deque(maxlen=HISTORY_LIMIT)) + 100
+
+def _gist(turn: Turn) -> str:
+    """Xabarning qisqa ko'rinishi"""
+    label = "Foydalanuvchi" if turn.role == "user" else "AI"
+    text = " ".join(turn.content.split())
+    if len(text) > GIST_CHARS:
+        text = text[:GIST_CHARS].rsplit(" ", 1)[0] + "…"
+    return f"{label}: {text}"
+
+def roll_summary(summary: str, turns) -> str:
+    """Eski xabarlarni qisqacha mazmunga qo'shish (eng eskilari chegaradan chiqadi)"""
+    lines = summary.splitlines() if summary else []
+    lines.extend(_gist(t) for t in turns)
+    sizes = [count_tokens(line) + 1 for line in lines]
+    total = sum(sizes)
+    start = 0
+    while total > AI_SUMMARY_TOKENS and start < len(lines):
+        total -= sizes[start]
+        start += 1
+    return "\n".join(lines[start:])
+
+class ConversationCache:
+    """Suhbat tarixi keshi: xotira chegarasi bilan LRU, sovuq foydalanuvchilar diskda qoladi"""
+
+    def __init__(self, backend: Storage, budget_bytes: int):
+        self.backend = backend
+        self.budget_bytes = budget_bytes
+        self._users: "OrderedDict[str, deque]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._summaries: Dict[str, str] = {}
+        self._bytes = 0
+        self._appended = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _measure(turns: deque) -> int:
+        return USER_OVERHEAD + sum(TURN_OVERHEAD + sys.getsizeof(t.content) for t in turns)
+
+    def _store(self, uid: str, turns: deque):
+        size = self._measure(turns) + sys.getsizeof(self._summaries.get(uid, ""))
+        self._bytes += size - self._sizes.get(uid, 0)
+        self._sizes[uid] = size
+        self._users[uid] = turns
+        self._users.move_to_end(uid)
+        # Eng uzoq ishlatilmaganlarni chiqarish (ular diskda saqlangan)
+        while self._bytes > self.budget_bytes and len(self._users) > 1:
+            old_uid, _ = self._users.popitem(last=False)
+            self._bytes -= self._sizes.pop(old_uid)
+            self._summaries.pop(old_uid, None)
+            self.evictions += 1
+
+    async def get(self, user_id: int) -> List[dict]:
+        """Foydalanuvchining oxirgi xabarlari"""
+        return [t.as_dict() for t in await self._turns(user_id)]
+
+    async def window(self, user_id: int, budget: int = AI_HISTORY_TOKENS) -> tuple:
+        """Token chegarasiga sig'adigan oxirgi xabarlar va eskilarining qisqacha mazmuni"""
+        turns = await self._turns(user_id)
+        packed = []
+        used = 0
+        for turn in reversed(turns):
+            if used + turn.tokens > budget:
+                break
+            packed.append(turn)
+            used += turn.tokens
+        packed.reverse()
+        summary = self._summaries.get(str(user_id), "")
+        folded = len(turns) - len(packed)
+        if folded:
+            summary = roll_summary(summary, list(turns)[:folded])
+        return summary, [t.as_dict() for t in packed]
+
+    async def _turns(self, user_id: int) -> deque:
+        uid = str(user_id)
+        turns = self._users.get(uid)
+        if turns is not None:
+            self.hits += 1
+            self._users.move_to_end(uid)
+        else:
+            self.misses += 1
+            # Shu foydalanuvchining yozuvlari navbatda bo'lsa, faqat ular diskka tushishi kutiladi
+            await data_writer.wait_for(lambda: not self.backend.history_pending(user_id))
+            history = await asyncio.to_thread(self.backend.load_history, user_id)
+            turns = self._users.get(uid)
+            if turns is None:
+                turns = deque((Turn(e["role"], e["content"]) for e in history), maxlen=HISTORY_LIMIT)
+                self._store(uid, turns)
+        return turns
+
+    def append(self, user_id: int, entries: List[dict]):
+        """Xabarlarni qo'shish (diskka faqat yangi qatorlar yoziladi)"""
+        uid = str(user_id)
+        self.backend.append_history(user_id, entries)
+        self._appended += len(entries)
+        turns = self._users.get(uid)
+        # Keshda bo'lmasa, keyingi o'qishda diskdan yuklanadi
+        if turns is not None:
+            # Oynadan chiqadigan xabarlar qisqacha mazmunga o'tadi
+            overflow = len(turns) + len(entries) - HISTORY_LIMIT
+            if overflow > 0:
+                dropped = [turns[i] for i in range(min(overflow, len(turns)))]
+                self._summaries[uid] = roll_summary(self._summaries.get(uid, ""), dropped)
+            turns.extend(Turn(e["role"], e["content"]) for e in entries)
+            self._store(uid, turns)
+
+    def compact(self):
+        """Jurnalni saqlash oynasigacha qisqartirish"""
+        if not self._appended:
+            return
+        self._appended = 0
+        self.backend.compact_history(HISTORY_LIMIT)
+
+    def stats(self) -> dict:
+        """Kesh ko'rsatkichlari"""
+        total = self.hits + self.misses
+        return {
+            "users": len(self._users),
+            "bytes": self._bytes,
+            "budget": self.budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+        }
+
+conversation_cache = ConversationCache(storage, HISTORY_CACHE_BYTES)
+
+async def history_compactor():
+    """Foydalanuvchilar, suhbat va a'zolik jurnallarini vaqti-vaqti bilan siqish"""
+    while True:
+        await asyncio.sleep(HISTORY_COMPACT_INTERVAL)
+        user_store.compact()
+        conversation_cache.compact()
+        membership_index.compact()
 
 # ==================== AI TIZIMI ====================
 
@@ -216,35 +1531,598 @@ def cleanup_expired_codes():
 openai_client = None
 if OPENAI_AVAILABLE and OPENAI_API_KEY:
     try:
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
         logger.info("✅ OpenAI client yaratildi")
     except Exception as e:
         logger.error(f"❌ OpenAI xatolik: {e}")
 
-# Gemini model
+# Gemini model (birinchi AI so'rovida yoki fonda aniqlanadi)
+GEMINI_MODEL_NAMES = ['gemini-2.0-flash-exp', 'gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-pro']
+GEMINI_MODEL_FILE = os.path.join(DATA_DIR, 'gemini_model.json')
+
+# Tanlangan model qancha vaqt qayta tekshirilmaydi (soniya)
+GEMINI_MODEL_TTL = int(os.getenv('GEMINI_MODEL_TTL', str(24 * 3600)))
+
+# Hech bir model ishlamasa, qayta tekshirishgacha kutish (soniya)
+GEMINI_PROBE_RETRY = 300
+
 gemini_model = None
+_gemini_probe: Optional[asyncio.Task] = None
+_gemini_probe_failed_at = 0.0
+
 if GEMINI_AVAILABLE and GEMINI_API_KEY:
     try:
         genai.configure(api_key=GEMINI_API_KEY)
         
-        # Model tanlash
-        model_names = ['gemini-2.0-flash-exp', 'gemini-1.5-flash', 'gemini-1.5-pro', 'gemini-pro']
-        
-        for model_name in model_names:
-            try:
-                test_model = genai.GenerativeModel(model_name)
-                test_response = test_model.generate_content('test', generation_config={"max_output_tokens": 10})
-                if test_response and hasattr(test_response, 'text'):
-                    gemini_model = test_model
-                    logger.info(f"✅ Gemini model yuklandi: {model_name}")
-                    break
-            except:
-                continue
+        # Oldingi ishga tushirishda tanlangan model (tarmoqqa murojaatsiz)
+        cached_model = load_data(GEMINI_MODEL_FILE, {})
+        if cached_model.get("model") and time.time() - cached_model.get("checked_at", 0) < GEMINI_MODEL_TTL:
+            gemini_model = genai.GenerativeModel(cached_model["model"])
+            logger.info(f"✅ Gemini model (keshdan): {cached_model['model']}")
     except Exception as e:
         logger.error(f"❌ Gemini xatolik: {e}")
 
-async def get_ai_response(user_message: str, user_id: int) -> str:
-    """AI dan javob olish"""
+async def _probe_gemini_model(model_name: str):
+    """Bitta modelni sinash"""
+    model = genai.GenerativeModel(model_name)
+    response = await asyncio.wait_for(
+        model.generate_content_async('test', generation_config={"max_output_tokens": 10}),
+        AI_TIMEOUT
+    )
+    if not response or not hasattr(response, 'text'):
+        raise ValueError("bo'sh javob")
+    return model
+
+async def discover_gemini_model():
+    """Barcha modellarni parallel sinab, ro'yxatdagi birinchi ishlaganini tanlash"""
+    global gemini_model, _gemini_probe_failed_at
+    results = await asyncio.gather(
+        *[_probe_gemini_model(name) for name in GEMINI_MODEL_NAMES],
+        return_exceptions=True
+    )
+    for model_name, result in zip(GEMINI_MODEL_NAMES, results):
+        if isinstance(result, BaseException):
+            logger.warning(f"Gemini {model_name} ishlamadi: {result}")
+            continue
+        gemini_model = result
+        save_data(GEMINI_MODEL_FILE, {"model": model_name, "checked_at": time.time()})
+        logger.info(f"✅ Gemini model yuklandi: {model_name}")
+        return gemini_model
+    _gemini_probe_failed_at = time.monotonic()
+    logger.error("❌ Hech bir Gemini modeli ishlamadi")
+    return None
+
+async def ensure_gemini_model():
+    """Gemini modeli (kerak bo'lsa aniqlanadi, bir vaqtda faqat bitta tekshiruv)"""
+    global _gemini_probe
+    if gemini_model is not None or not (GEMINI_AVAILABLE and GEMINI_API_KEY):
+        return gemini_model
+    if _gemini_probe_failed_at and time.monotonic() - _gemini_probe_failed_at < GEMINI_PROBE_RETRY:
+        return None
+    if _gemini_probe is None or _gemini_probe.done():
+        _gemini_probe = asyncio.create_task(discover_gemini_model())
+    return await asyncio.shield(_gemini_probe)
+
+# OpenAI modeli
+OPENAI_MODEL = "gpt-4o-mini"
+
+# Bir vaqtda bajariladigan AI so'rovlari soni
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', '8'))
+
+# Bitta AI so'rovi uchun vaqt chegarasi (soniya)
+AI_TIMEOUT = float(os.getenv('AI_TIMEOUT', '60'))
+
+_ai_semaphore: Optional[asyncio.Semaphore] = None
+_ai_semaphore_loop = None
+
+def ai_semaphore() -> asyncio.Semaphore:
+    """Joriy event loop uchun AI so'rovlari cheklovchisi"""
+    global _ai_semaphore, _ai_semaphore_loop
+    loop = asyncio.get_running_loop()
+    if _ai_semaphore is None or _ai_semaphore_loop is not loop:
+        _ai_semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+        _ai_semaphore_loop = loop
+    return _ai_semaphore
+
+# AI navbatidagi so'rovlar soni chegarasi
+AI_QUEUE_LIMIT = int(os.getenv('AI_QUEUE_LIMIT', '200'))
+
+# Navbat o'rnini xabarda yangilash oralig'i (soniya)
+AI_QUEUE_UPDATE_INTERVAL = float(os.getenv('AI_QUEUE_UPDATE_INTERVAL', '3'))
+
+# Navbat yo'laklari: kichik raqam birinchi xizmat qilinadi
+PRIORITY_ADMIN = 0
+PRIORITY_VERIFIED = 1
+PRIORITY_DEFAULT = 2
+
+class AIQueueFull(Exception):
+    """AI navbati to'lgan"""
+
+class AIJob:
+    """Navbatda slot kutayotgan so'rov"""
+
+    __slots__ = ('user_id', 'future', 'moved')
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.future = asyncio.get_running_loop().create_future()
+        self.moved = asyncio.Event()
+
+class AIScheduler:
+    """Adolatli navbat: yo'laklar ustuvorlik bo'yicha, yo'lak ichida foydalanuvchilar navbatma-navbat"""
+
+    def __init__(self, slots: int = AI_MAX_CONCURRENCY, limit: int = AI_QUEUE_LIMIT):
+        self.slots = slots
+        self.limit = limit
+        self.active = 0
+        self._lanes: Dict[int, "OrderedDict[int, deque]"] = {
+            PRIORITY_ADMIN: OrderedDict(),
+            PRIORITY_VERIFIED: OrderedDict(),
+            PRIORITY_DEFAULT: OrderedDict(),
+        }
+        self._queued = 0
+
+    def _order(self):
+        """Navbatdagi so'rovlar xizmat qilinish tartibida"""
+        for lane in sorted(self._lanes):
+            users = self._lanes[lane]
+            depth = max((len(q) for q in users.values()), default=0)
+            for rank in range(depth):
+                for jobs in users.values():
+                    if rank < len(jobs):
+                        yield jobs[rank]
+
+    def position(self, job: AIJob) -> int:
+        """So'rovning navbatdagi o'rni (1 - keyingisi)"""
+        for index, queued in enumerate(self._order(), 1):
+            if queued is job:
+                return index
+        return 0
+
+    def _dispatch(self):
+        while self.active < self.slots and self._queued:
+            lane = next(l for l in sorted(self._lanes) if self._lanes[l])
+            users = self._lanes[lane]
+            user_id, jobs = next(iter(users.items()))
+            job = jobs.popleft()
+            # Foydalanuvchi yo'lak oxiriga o'tadi: boshqalar ham navbat oladi
+            if jobs:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            self._queued -= 1
+            self.active += 1
+            job.future.set_result(True)
+        for lane in self._lanes.values():
+            for jobs in lane.values():
+                for job in jobs:
+                    job.moved.set()
+
+    def _remove(self, job: AIJob, lane: int):
+        jobs = self._lanes[lane].get(job.user_id)
+        if jobs is not None and job in jobs:
+            jobs.remove(job)
+            self._queued -= 1
+            if not jobs:
+                del self._lanes[lane][job.user_id]
+            self._dispatch()
+
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+
+    async def acquire(self, user_id: int, priority: int = PRIORITY_DEFAULT,
+                      on_position: Optional[Callable[[int], Awaitable[None]]] = None):
+        """Slot olish; kutish paytida on_position navbat o'rni bilan chaqiriladi"""
+        if self.active < self.slots and not self._queued:
+            self.active += 1
+            return
+        if self._queued >= self.limit:
+            raise AIQueueFull()
+        job = AIJob(user_id)
+        self._lanes[priority].setdefault(user_id, deque()).append(job)
+        self._queued += 1
+        shown = 0
+        last_update = 0.0
+        try:
+            while not job.future.done():
+                job.moved.clear()
+                if on_position and time.monotonic() - last_update >= AI_QUEUE_UPDATE_INTERVAL:
+                    position = self.position(job)
+                    if position != shown:
+                        shown, last_update = position, time.monotonic()
+                        try:
+                            await on_position(position)
+                        except Exception as e:
+                            logger.debug(f"Navbat o'rnini ko'rsatib bo'lmadi: {e}")
+                        continue
+                moved = asyncio.ensure_future(job.moved.wait())
+                try:
+                    await asyncio.wait([job.future, moved], timeout=AI_QUEUE_UPDATE_INTERVAL,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    moved.cancel()
+        except asyncio.CancelledError:
+            if job.future.done():
+                self.release()
+            else:
+                job.future.cancel()
+                self._remove(job, priority)
+            raise
+
+    def stats(self) -> dict:
+        return {"active": self.active, "queued": self._queued, "slots": self.slots, "limit": self.limit}
+
+ai_scheduler = AIScheduler()
+
+# Javobni yozilish jarayonida ko'rsatish (1 - yoqilgan, 0 - o'chirilgan)
+AI_STREAMING = os.getenv('AI_STREAMING', '1') == '1'
+
+# Oqim paytida xabarni tahrirlash oralig'i (Telegram cheklovlari uchun, soniya)
+AI_STREAM_EDIT_INTERVAL = float(os.getenv('AI_STREAM_EDIT_INTERVAL', '1.5'))
+
+# Ketma-ket xabarlarni bitta savolga birlashtirish oynasi (soniya, 0 - o'chirilgan).
+# Faqat javobi hali kutilayotgan savolga qo'shimcha kelganda kutiladi, birinchi xabar darhol ishlanadi
+AI_DEBOUNCE_SECONDS = float(os.getenv('AI_DEBOUNCE_SECONDS', '0.8'))
+
+PartialCallback = Callable[[str], Awaitable[None]]
+
+async def ask_gemini(prompt: str, on_partial: Optional[PartialCallback] = None) -> Optional[str]:
+    """Gemini dan javob (event loop'ni bloklamasdan)"""
+    async with ai_semaphore():
+        if on_partial is None:
+            response = await asyncio.wait_for(gemini_model.generate_content_async(prompt), AI_TIMEOUT)
+            if response and hasattr(response, 'text') and response.text:
+                return response.text
+            return None
+        
+        text = ""
+        async with asyncio.timeout(AI_TIMEOUT):
+            response = await gemini_model.generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                try:
+                    piece = chunk.text
+                except ValueError:
+                    # Xavfsizlik filtri sababli bo'sh bo'lak
+                    continue
+                if piece:
+                    text += piece
+                    await on_partial(text)
+        return text or None
+
+async def ask_openai(messages: List[dict], on_partial: Optional[PartialCallback] = None) -> str:
+    """OpenAI dan javob (event loop'ni bloklamasdan)"""
+    async with ai_semaphore():
+        if on_partial is None:
+            response = await asyncio.wait_for(
+                openai_client.chat.completions.create(
+                    model=OPENAI_MODEL,
+                    messages=messages,
+                    max_tokens=1000,
+                    temperature=0.7
+                ),
+                AI_TIMEOUT
+            )
+            return response.choices[0].message.content
+        
+        text = ""
+        async with asyncio.timeout(AI_TIMEOUT):
+            stream = await openai_client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                max_tokens=1000,
+                temperature=0.7,
+                stream=True
+            )
+            async for chunk in stream:
+                piece = chunk.choices[0].delta.content if chunk.choices else None
+                if piece:
+                    text += piece
+                    await on_partial(text)
+        return text
+
+# ==================== JAVOBLAR KESHI ====================
+
+# Javoblar keshi: amal qilish muddati (soniya), hajmi va diskka saqlash
+AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', str(24 * 3600)))
+AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', '500'))
+AI_CACHE_PERSIST = os.getenv('AI_CACHE_PERSIST', '1') == '1'
+AI_CACHE_FILE = os.path.join(DATA_DIR, 'answer_cache.json')
+
+def normalize_question(text: str) -> str:
+    """Savolni solishtirish uchun: kichik harf, ortiqcha bo'sh joy va tinish belgilarisiz"""
+    text = ' '.join(text.lower().split())
+    return text.strip(' .,!?;:')
+
+class ResponseCache:
+    """Takroriy savollar uchun javoblar keshi (TTL + LRU)"""
+
+    def __init__(self, max_size: int, ttl: int, filename: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.filename = filename
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._loaded = False
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def key(question: str, system_prompt: str, provider: str, model: str, context: str = "") -> str:
+        """Kesh kaliti; context - suhbat tarixi izi (tarixsiz savollar uchun bo'sh)"""
+        parts = [normalize_question(question), system_prompt, provider, model]
+        if context:
+            parts.append(context)
+        raw = '\x00'.join(parts)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _ensure_loaded(self):
+        """Saqlangan keshni faqat birinchi murojaatda yuklash"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if self.filename:
+            now = time.time()
+            for key, entry in load_data(self.filename, {"entries": {}}).get("entries", {}).items():
+                if entry[1] > now:
+                    self._entries[key] = entry
+
+    def preload(self):
+        """Ishga tushishda oldindan yuklash"""
+        self._ensure_loaded()
+
+    def get(self, key: str) -> Optional[str]:
+        """Keshdagi javob ([javob, muddati, yaratish vaqti])"""
+        return self.get_any([key])
+
+    def get_any(self, keys: List[str]) -> Optional[str]:
+        """Kalitlardan birinchi topilgan javob (bitta so'rov sifatida hisoblanadi)"""
+        self._ensure_loaded()
+        now = time.time()
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            if entry[1] <= now:
+                del self._entries[key]
+                self._dirty = True
+                continue
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry[2]
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def put(self, key: str, answer: str, latency: float):
+        self._ensure_loaded()
+        self._entries[key] = [answer, time.time() + self.ttl, latency]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def flush(self):
+        """O'zgarishlar bo'lsa diskka yozish"""
+        if self.filename and self._dirty:
+            save_data(self.filename, {"entries": dict(self._entries)})
+            self._dirty = False
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "saved_seconds": self.saved_seconds,
+        }
+
+answer_cache = ResponseCache(AI_CACHE_SIZE, AI_CACHE_TTL, AI_CACHE_FILE if AI_CACHE_PERSIST else None)
+
+async def cache_answer(key: Optional[str], generate: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+    """Yangi javobni yaratib keshga qo'yish (keshdan qidirish provayderga murojaatdan oldin; key=None - keshsiz)"""
+    started = time.monotonic()
+    answer = await generate()
+    if key is not None and answer:
+        answer_cache.put(key, answer, time.monotonic() - started)
+    return answer
+
+# ==================== PROVAYDERLARNI YO'NALTIRISH ====================
+
+# Circuit breaker: oxirgi natijalar oynasi, xatolar ulushi va sekinlik chegarasi
+ROUTER_WINDOW = 20
+ROUTER_MIN_SAMPLES = 5
+ROUTER_ERROR_RATE = 0.5
+ROUTER_MAX_CONSECUTIVE_FAILURES = 3
+ROUTER_SLOW_SECONDS = float(os.getenv('AI_SLOW_SECONDS', '20'))
+ROUTER_COOLDOWN = float(os.getenv('AI_CIRCUIT_COOLDOWN', '30'))
+
+# Shuncha soniyada javob boshlanmasa ikkinchi provayderga ham yuborish (0 - o'chirilgan)
+AI_HEDGE_AFTER = float(os.getenv('AI_HEDGE_AFTER', '0'))
+
+class ProviderHealth:
+    """Provayderning so'nggi kechikishlari, xatolari va circuit holati"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: deque = deque(maxlen=ROUTER_WINDOW)
+        self.outcomes: deque = deque(maxlen=ROUTER_WINDOW)
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.requests = 0
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def p50(self) -> float:
+        return statistics.median(self.latencies) if self.latencies else 0.0
+
+    def available(self) -> bool:
+        """So'rov yuborish mumkinmi (holatni o'zgartirmaydi)"""
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= ROUTER_COOLDOWN
+        return self.state == "closed"
+
+    def begin(self) -> Optional[bool]:
+        """So'rovni boshlash: None - mumkin emas, True - sinov so'rovi, False - oddiy so'rov"""
+        if self.state == "closed":
+            return False
+        if not self.available():
+            return None
+        # Ochiq circuit sovidi: bitta sinov so'rovi
+        self.state = "half_open"
+        return True
+
+    def abort_trial(self):
+        """Sinov so'rovi bekor qilindi: circuit yana ochiq, sovish qaytadan"""
+        if self.state == "half_open":
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        if self.state == "half_open":
+            self.state = "closed"
+        elif len(self.latencies) >= ROUTER_MIN_SAMPLES and self.p50() > ROUTER_SLOW_SECONDS:
+            self._open("sekin")
+
+    def record_failure(self):
+        self.requests += 1
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        if (self.state == "half_open"
+                or self.consecutive_failures >= ROUTER_MAX_CONSECUTIVE_FAILURES
+                or (len(self.outcomes) >= ROUTER_MIN_SAMPLES and self.error_rate() >= ROUTER_ERROR_RATE)):
+            self._open("xatolar")
+
+    def _open(self, reason: str):
+        if self.state != "open":
+            logger.warning(f"⚡ {self.name} circuit ochildi ({reason})")
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        # Qayta yopilgach eski natijalar hisobga olinmaydi
+        self.outcomes.clear()
+        self.latencies.clear()
+
+ProviderCall = Callable[[Optional[PartialCallback]], Awaitable[Optional[str]]]
+
+class ProviderRouter:
+    """Sog'lom provayderni tanlash, xatoda boshqasiga o'tish, ixtiyoriy hedging"""
+
+    def __init__(self, names: List[str]):
+        self.health = {name: ProviderHealth(name) for name in names}
+
+    def order(self, preferred: str, names) -> List[str]:
+        """Mavjud provayderlar: tanlangani birinchi, qolganlari sog'lomligi bo'yicha"""
+        available = [name for name in names if self.health[name].available()]
+        return sorted(available, key=lambda n: (
+            n != preferred, self.health[n].error_rate(), self.health[n].p50()
+        ))
+
+    async def _attempt(self, name: str, call: ProviderCall, on_partial: Optional[PartialCallback]) -> Optional[str]:
+        health = self.health[name]
+        trial = health.begin()
+        if trial is None:
+            # Boshqa so'rov sinovni allaqachon boshlagan
+            return None
+        started = time.monotonic()
+        try:
+            answer = await call(on_partial)
+        except asyncio.CancelledError:
+            if trial:
+                health.abort_trial()
+            raise
+        except Exception:
+            health.record_failure()
+            raise
+        if not answer:
+            health.record_failure()
+            return None
+        health.record_success(time.monotonic() - started)
+        return answer
+
+    async def _race(self, group: List[str], calls: Dict[str, ProviderCall],
+                    on_partial: Optional[PartialCallback]) -> tuple:
+        """Birinchi provayder; javob kechiksa ikkinchisi ham. (javob, sinalganlar soni, xato)"""
+        claimed: List[str] = []
+
+        def gate(name: str) -> Optional[PartialCallback]:
+            if on_partial is None:
+                return None
+
+            async def partial(text: str):
+                # Birinchi yozishni boshlagan provayder xabarni egallaydi
+                if not claimed:
+                    claimed.append(name)
+                if claimed[0] == name:
+                    await on_partial(text)
+            return partial
+
+        tasks = {asyncio.create_task(self._attempt(group[0], calls[group[0]], gate(group[0]))): group[0]}
+        error: Optional[BaseException] = None
+        try:
+            if len(group) > 1:
+                done, _ = await asyncio.wait(tasks, timeout=AI_HEDGE_AFTER)
+                if not done and not claimed:
+                    logger.info(f"↪️ {group[0]} kechikdi, {group[1]} ga ham yuborildi")
+                    tasks[asyncio.create_task(self._attempt(group[1], calls[group[1]], gate(group[1])))] = group[1]
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    answer = task.result()
+                    if answer and (not claimed or claimed[0] == tasks[task]):
+                        return answer, len(tasks), None
+        finally:
+            for task in tasks:
+                task.cancel()
+        return None, len(tasks), error
+
+    async def route(self, preferred: str, calls: Dict[str, ProviderCall],
+                    on_partial: Optional[PartialCallback] = None) -> Optional[str]:
+        """Javob olish: tanlangan provayder, xato bo'lsa keyingisi"""
+        order = self.order(preferred, calls)
+        if not order:
+            raise RuntimeError("AI provayderlari vaqtincha ishlamayapti")
+        error: Optional[BaseException] = None
+        while order:
+            group = order[:2] if AI_HEDGE_AFTER > 0 else order[:1]
+            answer, tried, failure = await self._race(group, calls, on_partial)
+            if answer:
+                return answer
+            if failure is not None:
+                logger.warning(f"AI provayder xatolik ({', '.join(order[:tried])}): {failure}")
+                error = failure
+            order = order[tried:]
+        if error is not None:
+            raise error
+        return None
+
+    def status(self) -> List[dict]:
+        return [
+            {
+                "name": h.name,
+                "state": h.state,
+                "p50": h.p50(),
+                "error_rate": h.error_rate(),
+                "requests": h.requests,
+            }
+            for h in self.health.values()
+        ]
+
+provider_router = ProviderRouter(["gemini", "openai"])
+
+async def get_ai_response(user_message: str, user_id: int, on_partial: Optional[PartialCallback] = None) -> str:
+    """AI dan javob olish (on_partial berilsa, javob yozilish jarayonida uzatiladi)"""
     settings = get_settings()
     
     if not settings.get("ai_enabled", True):
@@ -253,88 +2131,347 @@ async def get_ai_response(user_message: str, user_id: int) -> str:
     system_prompt = settings.get("ai_system_prompt", DEFAULT_SETTINGS["ai_system_prompt"])
     provider = settings.get("ai_provider", "gemini")
     
-    # Chat history
-    chat_history = load_data(CHAT_HISTORY_FILE, {"users": {}})
-    user_history = chat_history.get("users", {}).get(str(user_id), [])
+    # Chat history: token chegarasidagi oxirgi xabarlar, eskilari qisqacha
+    summary, user_history = await conversation_cache.window(user_id)
+    # Qisqacha mazmun foydalanuvchi matnidan iborat: tizim xabariga emas, alohida xabar sifatida
+    context_messages = list(user_history)
+    if summary:
+        context_messages.insert(0, {"role": "user", "content": f"Oldingi suhbat qisqacha:\n{summary}"})
+    
+    # Javob suhbat tarixiga bog'liq: kesh kaliti yuborilgan tarix izini ham o'z ichiga oladi
+    context = hashlib.sha256(
+        json.dumps(context_messages, ensure_ascii=False).encode('utf-8')
+    ).hexdigest() if context_messages else ""
+    
+    calls: Dict[str, ProviderCall] = {}
+    keys: Dict[str, str] = {}
+    
+    # Gemini: tanlangan bo'lsa modelni kutamiz, aks holda faqat tayyor bo'lsa
+    if (await ensure_gemini_model() if provider == "gemini" else gemini_model) is not None:
+        lines = [system_prompt]
+        lines.extend(
+            f"{'Foydalanuvchi' if m['role'] == 'user' else 'AI'}: {m['content']}" for m in context_messages
+        )
+        lines.append(f"Foydalanuvchi: {user_message}")
+        prompt = "\n\n".join(lines)
+        keys["gemini"] = answer_cache.key(
+            user_message, system_prompt, "gemini", getattr(gemini_model, 'model_name', 'gemini'), context
+        )
+        calls["gemini"] = lambda partial: cache_answer(keys["gemini"], lambda: ask_gemini(prompt, partial))
     
-    try:
-        # Avval Gemini dan foydalanish
-        if provider == "gemini" and gemini_model:
-            prompt = f"{system_prompt}\n\nFoydalanuvchi: {user_message}"
-            response = gemini_model.generate_content(prompt)
-            if response and hasattr(response, 'text') and response.text:
-                answer = response.text
-                
-                # Historiyaga qo'shish
-                user_history.append({"role": "user", "content": user_message})
-                user_history.append({"role": "assistant", "content": answer})
-                user_history = user_history[-20:]  # Oxirgi 20 ta xabar
-                
-                chat_history["users"][str(user_id)] = user_history
-                save_data(CHAT_HISTORY_FILE, chat_history)
-                
-                return answer
-        
-        # OpenAI dan foydalanish
-        if openai_client:
-            messages = [{"role": "system", "content": system_prompt}]
-            messages.extend(user_history[-10:])  # Oxirgi 10 ta xabar
-            messages.append({"role": "user", "content": user_message})
-            
-            response = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                max_tokens=1000,
-                temperature=0.7
-            )
-            
-            answer = response.choices[0].message.content
-            
-            # Historiyaga qo'shish
-            user_history.append({"role": "user", "content": user_message})
-            user_history.append({"role": "assistant", "content": answer})
-            user_history = user_history[-20:]
-            
-            chat_history["users"][str(user_id)] = user_history
-            save_data(CHAT_HISTORY_FILE, chat_history)
-            
-            return answer
+    if openai_client:
+        messages = [{"role": "system", "content": system_prompt}]
+        messages.extend(context_messages)
+        messages.append({"role": "user", "content": user_message})
         
+        keys["openai"] = answer_cache.key(
+            user_message, system_prompt, "openai", OPENAI_MODEL, context
+        )
+        calls["openai"] = lambda partial: cache_answer(keys["openai"], lambda: ask_openai(messages, partial))
+    
+    if not calls:
         return "❌ AI yordamchi mavjud emas. Iltimos, keyinroq qayta urinib ko'ring."
-        
-    except Exception as e:
-        logger.error(f"AI xatolik: {e}")
-        return f"❌ Xatolik yuz berdi: {str(e)[:100]}"
+    
+    # Keshdagi javob router'siz qaytadi: circuit holati va kechikish statistikasi faqat haqiqiy so'rovlardan
+    answer = answer_cache.get_any([keys[name] for name in sorted(keys, key=lambda name: name != provider)])
+    if answer is None:
+        try:
+            answer = await provider_router.route(provider, calls, on_partial)
+        except Exception as e:
+            logger.error(f"AI xatolik: {e}")
+            return f"❌ Xatolik yuz berdi: {str(e)[:100]}"
+    
+    if not answer:
+        return "❌ AI yordamchi mavjud emas. Iltimos, keyinroq qayta urinib ko'ring."
+    
+    # Historiyaga qo'shish (oxirgi 20 ta xabar)
+    conversation_cache.append(user_id, [
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": answer}
+    ])
+    
+    return answer
+
+# ==================== SO'ROVLAR CHEKLOVI ====================
+
+# Foydalanuvchiga cheklov haqida qayta eslatish oralig'i (soniya)
+RATE_LIMIT_NOTICE_INTERVAL = 10
+
+# Ishlatilmagan chelaklarni tozalash oralig'i (soniya)
+RATE_LIMIT_PRUNE_INTERVAL = 60
+
+class RateLimiter:
+    """Token bucket cheklovchi: xotirada, faqat event loop ichida ishlatiladi"""
+
+    def __init__(self):
+        # (tur, user_id yoki None) -> [tokenlar, oxirgi vaqt, to'lish vaqti]
+        self._buckets: Dict[tuple, list] = {}
+        self._notified: Dict[int, float] = {}
+        self._next_prune = 0.0
+        self.rejected = 0
+
+    @staticmethod
+    def _limits(kind: str) -> Mapping:
+        limits = get_settings().get("rate_limits", DEFAULT_SETTINGS["rate_limits"])
+        return limits.get(kind) or DEFAULT_SETTINGS["rate_limits"].get(kind, {})
+
+    def _tokens(self, key: tuple, limit, now: float) -> float:
+        capacity, period = limit
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return float(capacity)
+        return min(float(capacity), bucket[0] + (now - bucket[1]) * capacity / period)
+
+    def check(self, kind: str, user_id: int) -> float:
+        """So'rovga ruxsat: 0 yoki necha soniyadan keyin urinish mumkinligi"""
+        if user_id in ADMIN_IDS:
+            return 0.0
+        now = time.monotonic()
+        if now >= self._next_prune:
+            self._prune(now)
+        limits = self._limits(kind)
+        buckets = [((kind, user_id), limits["user"])] if limits.get("user") else []
+        if limits.get("global"):
+            buckets.append(((kind, None), limits["global"]))
+        tokens = [self._tokens(key, limit, now) for key, limit in buckets]
+        wait = max(
+            ((1 - t) * limit[1] / limit[0] for t, (_, limit) in zip(tokens, buckets) if t < 1),
+            default=0.0,
+        )
+        if wait:
+            self.rejected += 1
+            return wait
+        for t, (key, (capacity, period)) in zip(tokens, buckets):
+            # Chelak to'lgach uni xotirada saqlash shart emas
+            self._buckets[key] = [t - 1, now, now + (capacity - t + 1) * period / capacity]
+        return 0.0
+
+    def should_notify(self, user_id: int) -> bool:
+        """Cheklov haqidagi xabar har safar emas, oraliq bilan yuboriladi"""
+        now = time.monotonic()
+        if now - self._notified.get(user_id, 0.0) < RATE_LIMIT_NOTICE_INTERVAL:
+            return False
+        self._notified[user_id] = now
+        return True
+
+    def _prune(self, now: float):
+        self._next_prune = now + RATE_LIMIT_PRUNE_INTERVAL
+        self._buckets = {k: b for k, b in self._buckets.items() if b[2] > now}
+        self._notified = {
+            uid: t for uid, t in self._notified.items() if now - t < RATE_LIMIT_NOTICE_INTERVAL
+        }
+
+rate_limiter = RateLimiter()
+
+async def rate_limited(update: Update, kind: str) -> bool:
+    """Cheklovdan oshgan bo'lsa foydalanuvchiga aytib, True qaytarish"""
+    user_id = update.effective_user.id
+    wait = rate_limiter.check(kind, user_id)
+    if not wait:
+        return False
+    logger.info(f"🚦 {user_id}: '{kind}' cheklovi ({wait:.0f} s)")
+    text = f"⏳ Juda ko'p so'rov. {max(1, round(wait))} soniyadan keyin qayta urinib ko'ring."
+    if update.callback_query:
+        await update.callback_query.answer(text, show_alert=True)
+    elif rate_limiter.should_notify(user_id):
+        await update.effective_message.reply_text(text)
+    return True
 
 # ==================== KANAL TEKSHIRUVI ====================
 
-async def check_channel_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> tuple:
-    """Foydalanuvchi majburiy kanallarga a'zo ekanligini tekshirish"""
+# Eslab qolinadigan (foydalanuvchi, kanal) juftliklari soni
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', '100000'))
+
+class MembershipCache:
+    """Kanal a'zoligi keshi: a'zo va a'zo emaslar uchun alohida muddat"""
+
+    def __init__(self, max_size: int = MEMBERSHIP_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, chat_id) -> Optional[bool]:
+        key = (user_id, chat_id)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, user_id: int, chat_id, is_member: bool):
+        ttls = get_settings().get("subscription_cache", DEFAULT_SETTINGS["subscription_cache"])
+        ttl = ttls.get("member_ttl", 600) if is_member else ttls.get("nonmember_ttl", 30)
+        key = (user_id, chat_id)
+        self._entries[key] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+membership_cache = MembershipCache()
+
+class MembershipIndex:
+    """chat_member update'laridan yig'iladigan a'zolik (bot admin bo'lgan kanallar uchun)"""
+
+    def __init__(self, backend: Storage):
+        self.backend = backend
+        self._channels: Optional[Dict[int, Dict[int, bool]]] = None
+        # Shu ishga tushishda tasdiqlangan yozuvlar. Bot to'xtagan paytdagi chat_member
+        # update'lari kelmaydi: diskdagi yozuv get_chat_member bilan bir marta qayta tekshiriladi
+        self._confirmed: Dict[int, set] = {}
+        self._changes = 0
+        self.hits = 0
+        self.stale = 0
+
+    def _loaded(self) -> Dict[int, Dict[int, bool]]:
+        """Fayldan faqat birinchi murojaatda yuklash"""
+        if self._channels is None:
+            self._channels = self.backend.load_memberships()
+        return self._channels
+
+    def preload(self):
+        """Ishga tushishda oldindan yuklash"""
+        self._loaded()
+
+    def get(self, chat_id: int, user_id: int) -> Optional[bool]:
+        """Ma'lum holat yoki None (foydalanuvchi hali ko'rilmagan yoki yozuv tasdiqlanmagan)"""
+        members = self._loaded().get(chat_id)
+        is_member = members.get(user_id) if members is not None else None
+        if is_member is None:
+            return None
+        if user_id not in self._confirmed.get(chat_id, ()):
+            self.stale += 1
+            return None
+        self.hits += 1
+        return is_member
+
+    def record(self, chat_id: int, user_id: int, is_member: bool):
+        """chat_member update'i yoki get_chat_member natijasi (yozuv tasdiqlanadi)"""
+        self._confirmed.setdefault(chat_id, set()).add(user_id)
+        members = self._loaded().setdefault(chat_id, {})
+        if members.get(user_id) == is_member:
+            return
+        members[user_id] = is_member
+        self._changes += 1
+        self.backend.save_memberships([(chat_id, user_id, is_member)])
+
+    def forget(self, chat_id: int):
+        """Bot adminlikdan chiqdi: kanal indeksi endi yangilanmaydi"""
+        self._confirmed.pop(chat_id, None)
+        if self._loaded().pop(chat_id, None) is not None:
+            self._changes += 1
+            self.backend.save_memberships([(chat_id, None, False)])
+
+    def compact(self):
+        if not self._changes:
+            return
+        self._changes = 0
+        self.backend.compact_memberships()
+
+    def stats(self) -> dict:
+        channels = self._loaded()
+        return {
+            "channels": len(channels),
+            "known": sum(len(members) for members in channels.values()),
+            "hits": self.hits,
+            "stale": self.stale,
+        }
+
+membership_index = MembershipIndex(storage)
+
+# Bitta get_chat_member so'rovi uchun vaqt chegarasi (soniya)
+SUBSCRIPTION_CHECK_TIMEOUT = float(os.getenv('SUBSCRIPTION_CHECK_TIMEOUT', '5'))
+
+async def fetch_membership(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id) -> Optional[bool]:
+    """Telegram'dan a'zolikni so'rash (xatolik yoki vaqt tugasa None)"""
+    try:
+        async with asyncio.timeout(SUBSCRIPTION_CHECK_TIMEOUT):
+            member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+    except Exception as e:
+        logger.error(f"Kanal tekshirishda xatolik ({chat_id}): {e!r}")
+        return None
+    is_member = is_member_status(member.status)
+    membership_cache.put(user_id, chat_id, is_member)
+    return is_member
+
+async def check_channel_subscription(user_id: int, context: ContextTypes.DEFAULT_TYPE, force: bool = False) -> tuple:
+    """Foydalanuvchi majburiy kanallarga a'zo ekanligini tekshirish (force - keshni chetlab)"""
     settings = get_settings()
-    required_channels = settings.get("required_channels", [])
+    required_channels = [ch for ch in settings.get("required_channels", []) if ch.get("chat_id")]
     
     if not required_channels:
         return True, []
     
-    not_subscribed = []
-    
-    for channel in required_channels:
-        try:
-            chat_id = channel.get("chat_id")
-            if not chat_id:
-                continue
-                
-            member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            
-            if member.status in ['left', 'kicked']:
-                not_subscribed.append(channel)
-        except Exception as e:
-            logger.error(f"Kanal tekshirishda xatolik: {e}")
-            # Xatolik bo'lsa ham davom etish
-            continue
-    
+    statuses = [None] * len(required_channels)
+    if not force:
+        for i, ch in enumerate(required_channels):
+            # Bot admin bo'lgan kanallarda a'zolik update'lardan ma'lum
+            if ch.get("bot_admin"):
+                statuses[i] = membership_index.get(ch["chat_id"], user_id)
+            if statuses[i] is None:
+                statuses[i] = membership_cache.get(user_id, ch["chat_id"])
+    
+    # Keshda yo'q kanallar bir vaqtda tekshiriladi: kutish bitta so'rov vaqtiga teng
+    unknown = [i for i, status in enumerate(statuses) if status is None]
+    if unknown:
+        fetched = await asyncio.gather(*(
+            fetch_membership(context, user_id, required_channels[i]["chat_id"]) for i in unknown
+        ))
+        # Tekshirib bo'lmasa: "allow" - a'zo deb hisoblash, "deny" - obuna so'rash
+        allow_on_error = settings.get("subscription_error_policy", "allow") != "deny"
+        for i, status in zip(unknown, fetched):
+            if status is not None and required_channels[i].get("bot_admin"):
+                # Keyingi o'zgarishlar chat_member update'lari orqali keladi
+                membership_index.record(required_channels[i]["chat_id"], user_id, status)
+            statuses[i] = allow_on_error if status is None else status
+    
+    not_subscribed = [ch for ch, status in zip(required_channels, statuses) if not status]
     return len(not_subscribed) == 0, not_subscribed
 
+def is_member_status(status: str) -> bool:
+    return status not in ['left', 'kicked']
+
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Majburiy kanalga qo'shilish/chiqishni a'zolik indeksiga yozish"""
+    change = update.chat_member
+    chat_id = change.chat.id
+    channel = next((ch for ch in get_settings().get("required_channels", []) if ch.get("chat_id") == chat_id), None)
+    if channel is None or not channel.get("bot_admin"):
+        return
+    user_id = change.new_chat_member.user.id
+    is_member = is_member_status(change.new_chat_member.status)
+    membership_index.record(chat_id, user_id, is_member)
+    membership_cache.put(user_id, chat_id, is_member)
+
+async def track_bot_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Bot majburiy kanalda admin bo'ldi yoki adminlikdan chiqdi"""
+    change = update.my_chat_member
+    chat_id = change.chat.id
+    bot_admin = change.new_chat_member.status == 'administrator'
+    
+    settings = get_settings_copy()
+    channel = next((ch for ch in settings.get("required_channels", []) if ch.get("chat_id") == chat_id), None)
+    if channel is None or channel.get("bot_admin", False) == bot_admin:
+        return
+    
+    channel["bot_admin"] = bot_admin
+    save_settings(settings)
+    if not bot_admin:
+        membership_index.forget(chat_id)
+    state = "yoqildi" if bot_admin else "o'chirildi"
+    logger.info(f"📢 {channel.get('title')}: a'zolik indeksi {state}")
+
 async def send_subscription_required(update: Update, context: ContextTypes.DEFAULT_TYPE, channels: list):
     """Obuna qilish kerakligi haqida xabar yuborish"""
     message = "⚠️ *Botdan foydalanish uchun quyidagi kanallarga obuna bo'ling:*\n\n"
@@ -388,7 +2525,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "last_name": user.last_name,
         "username": user.username,
         "last_active": datetime.now().isoformat(),
-        "verified": user_data.get("verified", False)
+        "verified": user_data.get("verified", False),
+        # Botni qayta ishga tushirgan foydalanuvchiga yana xabar yuborish mumkin
+        "active": True
     })
     save_user(user_id, user_data)
     
@@ -424,6 +2563,9 @@ async def get_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
     
+    if await rate_limited(update, "code"):
+        return
+    
     # Kanal obunasini tekshirish
     is_subscribed, not_subscribed = await check_channel_subscription(user_id, context)
     
@@ -461,6 +2603,9 @@ async def ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """AI yordamchi buyrug'i"""
     user_id = update.effective_user.id
     
+    if await rate_limited(update, "update"):
+        return
+    
     # Kanal obunasini tekshirish
     is_subscribed, not_subscribed = await check_channel_subscription(user_id, context)
     
@@ -479,15 +2624,94 @@ async def ai_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     question = " ".join(context.args)
-    await process_ai_message(update, context, question)
+    if await rate_limited(update, "ai"):
+        return
+    # AI javobi fonda: boshqa update'lar kutib qolmaydi
+    ai_sessions.submit(update, context, question)
+
+# Telegram xabari uzunligi chegarasi
+MESSAGE_LIMIT = 4096
+
+class StreamingReply:
+    """AI javobini kutish xabarida bosqichma-bosqich ko'rsatish"""
+
+    HEADER = "🤖 AI Javob:\n\n"
+
+    def __init__(self, message, interval: float = AI_STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._last_edit = 0.0
+        self._shown = ""
+
+    async def update(self, text: str):
+        """Qisman javob: tahrirlar oralig'i cheklangan"""
+        now = time.monotonic()
+        if now - self._last_edit < self.interval:
+            return
+        self._last_edit = now
+        # Yozilayotgan matn Markdown sifatida to'liq bo'lmasligi mumkin
+        preview = text[-(MESSAGE_LIMIT - len(self.HEADER) - 2):]
+        # Oraliq ko'rinish ixtiyoriy: Telegram xatosi AI so'roviga ta'sir qilmaydi
+        try:
+            await self._edit(f"{self.HEADER}{preview} ▌")
+        except RetryAfter as e:
+            self._last_edit = now + e.retry_after
+            logger.warning(f"⏳ Qisman javobni tahrirlash {e.retry_after}s ga kechiktirildi")
+        except TelegramError as e:
+            logger.warning(f"Qisman javobni tahrirlab bo'lmadi: {e}")
+
+    async def finish(self, answer: str):
+        """Yakuniy javob: Markdown bilan, uzun bo'lsa bo'lib yuboriladi"""
+        full = f"🤖 *AI Javob:*\n\n{answer}"
+        parts = [full[i:i + MESSAGE_LIMIT] for i in range(0, len(full), MESSAGE_LIMIT)]
+        await self._edit(parts[0], parse_mode='Markdown')
+        for part in parts[1:]:
+            await self.message.reply_text(part)
+
+    async def _edit(self, text: str, parse_mode: Optional[str] = None):
+        if text == self._shown:
+            return
+        try:
+            await self.message.edit_text(text, parse_mode=parse_mode)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return
+            if parse_mode is None:
+                raise
+            # Markdown xatosi bo'lsa oddiy matn sifatida
+            await self.message.edit_text(text)
+        self._shown = text
 
-async def process_ai_message(update: Update, context: ContextTypes.DEFAULT_TYPE, question: str):
+async def process_ai_message(update: Update, context: ContextTypes.DEFAULT_TYPE, question: str, wait_msg=None):
     """AI xabarni qayta ishlash"""
     user_id = update.effective_user.id
     
-    wait_msg = await update.message.reply_text("🤔 O'ylamoqdaman...")
+    if wait_msg is None:
+        wait_msg = await update.message.reply_text("🤔 O'ylamoqdaman...")
+    
+    queued = []
+    
+    async def show_position(position: int):
+        queued.append(position)
+        await wait_msg.edit_text(f"⏳ Navbatdasiz: {position}-o'rin. Iltimos, kuting...")
+    
+    try:
+        await ai_scheduler.acquire(user_id, ai_priority(user_id), on_position=show_position)
+    except AIQueueFull:
+        logger.warning(f"⚠️ AI navbati to'la, so'rov rad etildi: {user_id}")
+        await wait_msg.edit_text("⏳ Hozir so'rovlar juda ko'p. Birozdan keyin qayta urinib ko'ring.")
+        return
     
     try:
+        if queued:
+            await wait_msg.edit_text("🤔 O'ylamoqdaman...")
+        
+        if AI_STREAMING:
+            reply = StreamingReply(wait_msg)
+            answer = await get_ai_response(question, user_id, on_partial=reply.update)
+            await reply.finish(answer)
+            return
+        
         answer = await get_ai_response(question, user_id)
         
         await wait_msg.delete()
@@ -498,6 +2722,74 @@ async def process_ai_message(update: Update, context: ContextTypes.DEFAULT_TYPE,
     except Exception as e:
         logger.error(f"AI xatolik: {e}")
         await wait_msg.edit_text(f"❌ Xatolik: {str(e)[:100]}")
+    finally:
+        ai_scheduler.release()
+
+def ai_priority(user_id: int) -> int:
+    """Navbat yo'lagi: adminlar, so'ng tasdiqlangan foydalanuvchilar"""
+    if user_id in ADMIN_IDS:
+        return PRIORITY_ADMIN
+    user = get_user(user_id)
+    if user and user.get("verified"):
+        return PRIORITY_VERIFIED
+    return PRIORITY_DEFAULT
+
+class AISession:
+    """Foydalanuvchining hali javob berilmagan xabarlari va ishlayotgan so'rovi"""
+
+    __slots__ = ("parts", "task", "wait_send")
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.task: Optional[asyncio.Task] = None
+        self.wait_send: Optional[asyncio.Task] = None
+
+class AISessionManager:
+    """Tez-tez kelgan xabarlarni birlashtirish va eskirgan so'rovni bekor qilish"""
+
+    def __init__(self, delay: float = AI_DEBOUNCE_SECONDS):
+        self.delay = delay
+        self._sessions: Dict[int, AISession] = {}
+
+    def submit(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        """Yangi xabar: oldingi javob kutilayotgan bo'lsa, unga qo'shib qayta boshlanadi"""
+        user_id = update.effective_user.id
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._sessions[user_id] = AISession()
+        session.parts.append(text)
+        burst = session.task is not None and not session.task.done()
+        if burst:
+            session.task.cancel()
+        else:
+            # Birinchi xabarga darhol javob: foydalanuvchi kutayotganini ko'radi
+            session.wait_send = asyncio.create_task(update.message.reply_text("🤔 O'ylamoqdaman..."))
+        session.task = context.application.create_task(
+            self._run(user_id, session, update, context, burst), update=update
+        )
+
+    async def _run(self, user_id: int, session: AISession, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                   burst: bool = False):
+        # Foydalanuvchi ketma-ket yozayotgan bo'lsa keyingi qismni biroz kutamiz
+        if burst and self.delay > 0:
+            await asyncio.sleep(self.delay)
+        # Bekor qilinsa ham xabar yuborilishi tugaydi va keyingi urinishda ishlatiladi
+        wait_msg = await asyncio.shield(session.wait_send)
+        if len(session.parts) > 1:
+            logger.info(f"🧩 {user_id}: {len(session.parts)} ta xabar bitta savolga birlashtirildi")
+        question = "\n".join(session.parts)
+        try:
+            await process_ai_message(update, context, question, wait_msg=wait_msg)
+        finally:
+            # Yangi xabar bilan almashtirilmagan bo'lsa sessiya yakunlanadi
+            if self._sessions.get(user_id) is session and session.task is asyncio.current_task():
+                del self._sessions[user_id]
+
+    def tasks(self) -> List[asyncio.Task]:
+        """Hali tugamagan so'rovlar"""
+        return [s.task for s in self._sessions.values() if s.task is not None and not s.task.done()]
+
+ai_sessions = AISessionManager()
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Yordam"""
@@ -532,12 +2824,11 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Sizda admin huquqi yo'q!")
         return
     
-    users = get_users()
-    codes = get_codes()
     settings = get_settings()
     
-    total_users = len(users.get("users", {}))
-    active_codes = len([c for c in codes.get("codes", {}).values() if not c.get("used")])
+    total_users = user_store.count()
+    total_codes, used_codes = code_table.stats()
+    active_codes = total_codes - used_codes
     total_channels = len(settings.get("required_channels", []))
     
     message = f"""⚙️ *Admin Panel*
@@ -588,8 +2879,11 @@ async def admin_add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Kanal ma'lumotlarini olish
     try:
         chat = await context.bot.get_chat(channel_username)
+        # Bot admin bo'lsa a'zolik chat_member update'laridan kuzatiladi
+        bot_member = await context.bot.get_chat_member(chat.id, context.bot.id)
         
-        settings = get_settings()
+        # Sozlamalar nusxasi await'lardan keyin olinadi: parallel o'zgarishlar yo'qolmaydi
+        settings = get_settings_copy()
         channels = settings.get("required_channels", [])
         
         # Mavjud emasligini tekshirish
@@ -602,7 +2896,8 @@ async def admin_add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "chat_id": chat.id,
             "username": chat.username,
             "title": channel_title or chat.title,
-            "url": f"https://t.me/{chat.username}" if chat.username else None
+            "url": f"https://t.me/{chat.username}" if chat.username else None,
+            "bot_admin": bot_member.status == 'administrator'
         })
         
         settings["required_channels"] = channels
@@ -612,6 +2907,8 @@ async def admin_add_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"✅ Kanal qo'shildi!\n\n"
             f"📢 {channel_title}\n"
             f"🔗 @{chat.username}"
+            + ("" if bot_member.status == 'administrator' else
+               "\n\n💡 Botni kanalga admin qilsangiz, obuna tekshiruvi tezroq ishlaydi.")
         )
         
     except Exception as e:
@@ -632,7 +2929,7 @@ async def admin_remove_channel(update: Update, context: ContextTypes.DEFAULT_TYP
     
     channel_username = context.args[0].replace("@", "")
     
-    settings = get_settings()
+    settings = get_settings_copy()
     channels = settings.get("required_channels", [])
     
     new_channels = [ch for ch in channels if ch.get("username") != channel_username]
@@ -646,6 +2943,31 @@ async def admin_remove_channel(update: Update, context: ContextTypes.DEFAULT_TYP
     
     await update.message.reply_text(f"✅ @{channel_username} kanali o'chirildi!")
 
+async def admin_subscription_cache(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """A'zolik keshi muddatlarini o'zgartirish"""
+    user_id = update.effective_user.id
+    
+    if user_id not in ADMIN_IDS:
+        await update.message.reply_text("❌ Admin huquqi yo'q!")
+        return
+    
+    if len(context.args) != 2 or not all(arg.isdigit() for arg in context.args):
+        await update.message.reply_text(
+            "❌ Format: /subcache <a'zo_soniya> <a'zo_emas_soniya>\n"
+            "Misol: /subcache 600 30"
+        )
+        return
+    
+    member_ttl, nonmember_ttl = int(context.args[0]), int(context.args[1])
+    
+    settings = get_settings_copy()
+    settings["subscription_cache"] = {"member_ttl": member_ttl, "nonmember_ttl": nonmember_ttl}
+    save_settings(settings)
+    
+    await update.message.reply_text(
+        f"✅ A'zolik keshi: a'zo {member_ttl} s, a'zo emas {nonmember_ttl} s"
+    )
+
 async def admin_list_channels(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Majburiy kanallar ro'yxati"""
     user_id = update.effective_user.id
@@ -668,53 +2990,400 @@ async def admin_list_channels(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text(message, parse_mode='Markdown')
 
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Barcha foydalanuvchilarga xabar yuborish"""
+    """Barcha foydalanuvchilarga xabar yuborish (fonda)"""
     user_id = update.effective_user.id
     
     if user_id not in ADMIN_IDS:
         await update.message.reply_text("❌ Admin huquqi yo'q!")
         return
     
-    if not context.args:
-        await update.message.reply_text("❌ Format: /broadcast Xabar matni")
+    # --force: yaqinda yuborilgan bo'lsa ham hammaga qaytadan
+    args = list(context.args or [])
+    force = bool(args) and args[0] == BROADCAST_FORCE_FLAG
+    if force:
+        args = args[1:]
+    
+    if not args:
+        await update.message.reply_text(
+            "❌ Format: /broadcast Xabar matni\n"
+            f"♻️ Hammaga qaytadan: /broadcast {BROADCAST_FORCE_FLAG} Xabar matni"
+        )
         return
     
-    message = " ".join(context.args)
-    users = get_users()
+    message = " ".join(args)
+    text = f"📢 *Admin xabari:*\n\n{message}"
     
-    sent = 0
-    failed = 0
+    if broadcast_engine.is_running(text):
+        await update.message.reply_text("⚠️ Bu xabar hozir tarqatilmoqda!")
+        return
     
-    for uid in users.get("users", {}).keys():
+    recipients = user_store.active_ids()
+    # Oldingi tarqatish jurnali diskka tushgach kimga yuborilgani aniq bo'ladi
+    await data_writer.barrier()
+    await asyncio.to_thread(prune_broadcasts)
+    # Tugamagan yoki yaqinda tugagan shu matnli tarqatish davom ettiriladi
+    job_id = None if force else await asyncio.to_thread(recent_broadcast_id, text)
+    status_message = await update.message.reply_text(
+        f"📢 Xabar tarqatish boshlanmoqda: {len(recipients)} ta foydalanuvchi..."
+    )
+    job = await broadcast_engine.start(
+        context.bot, text, recipients, status_message.chat_id, status_message.message_id, job_id
+    )
+    logger.info(f"📢 Tarqatish {job.id}: {len(job.pending)} ta foydalanuvchi, {job.skipped} tasiga oldin yuborilgan")
+
+# ==================== XABAR TARQATISH ====================
+
+# Tarqatishlar holati va kimga yuborilgani jurnali (qayta ishga tushganda davom etish uchun)
+BROADCASTS_DIR = os.path.join(DATA_DIR, 'broadcasts')
+
+# Telegram umumiy cheklovi: soniyasiga ~30 ta xabar
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '30'))
+
+# Bir vaqtda yuborilayotgan xabarlar soni
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+
+# Holat xabarini yangilash oralig'i (soniya)
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+
+# Bitta foydalanuvchiga yuborishga urinishlar soni
+BROADCAST_MAX_ATTEMPTS = 3
+
+# Shu muddat ichida bir xil matn qayta yuborilsa, oldin olganlarga takrorlanmaydi (soat);
+# eskiroq tarqatishlar fayllari o'chiriladi
+BROADCAST_DEDUP_HOURS = float(os.getenv('BROADCAST_DEDUP_HOURS', '24'))
+
+# /broadcast bayrog'i: yaqinda yuborilgan bo'lsa ham hammaga qaytadan
+BROADCAST_FORCE_FLAG = "--force"
+
+# Yuborish natijalari
+SENT, FAILED, GONE = "s", "f", "x"
+
+def broadcast_id(text: str) -> str:
+    """Matn izi: bir xil matnli tarqatishlarni topish uchun"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+
+def new_broadcast_id(text: str) -> str:
+    """Yangi tarqatish ID si: matn izi, boshlangan vaqt va tasodifiy qo'shimcha"""
+    return f"{broadcast_id(text)}-{datetime.now():%Y%m%d%H%M%S}-{secrets.token_hex(2)}"
+
+def broadcast_state_file(job_id: str) -> str:
+    return os.path.join(BROADCASTS_DIR, f"{job_id}.json")
+
+def broadcast_log_file(job_id: str) -> str:
+    return os.path.join(BROADCASTS_DIR, f"{job_id}.log")
+
+def load_broadcast_log(job_id: str) -> Dict[int, str]:
+    """Kimga qanday natija bilan yuborilgani"""
+    results: Dict[int, str] = {}
+    try:
+        with open(broadcast_log_file(job_id), 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                # Yarim yozilgan oxirgi qator
+                if len(parts) == 2 and parts[0].lstrip('-').isdigit():
+                    results[int(parts[0])] = parts[1]
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Fayl yuklashda xatolik: {e}")
+    return results
+
+def broadcast_delivered(job_id: str) -> set:
+    """Oldingi urinishlarda yetkazilganlar va bloklaganlar (xatoliklar qayta urinadi)"""
+    return {uid for uid, result in load_broadcast_log(job_id).items() if result in (SENT, GONE)}
+
+def iter_broadcast_states():
+    """Saqlangan tarqatishlar holati"""
+    if not os.path.isdir(BROADCASTS_DIR):
+        return
+    for name in sorted(os.listdir(BROADCASTS_DIR)):
+        if name.endswith('.json'):
+            state = load_data(os.path.join(BROADCASTS_DIR, name), {})
+            if state.get("id"):
+                yield state
+
+def broadcast_is_recent(state: dict) -> bool:
+    """Tugamagan yoki dedup muddati o'tmagan tarqatish"""
+    if state.get("status") == "running":
+        return True
+    try:
+        updated_at = datetime.fromisoformat(state["updated_at"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return datetime.now() - updated_at < timedelta(hours=BROADCAST_DEDUP_HOURS)
+
+def recent_broadcast_id(text: str) -> Optional[str]:
+    """Shu matnning davom ettiriladigan tarqatishi (yo'q bo'lsa None)"""
+    prefix = broadcast_id(text)
+    latest = None
+    for state in iter_broadcast_states():
+        if state["id"].split('-')[0] != prefix:
+            continue
+        if latest is None or state.get("updated_at", "") > latest.get("updated_at", ""):
+            latest = state
+    if latest is None or not broadcast_is_recent(latest):
+        return None
+    return latest["id"]
+
+def prune_broadcasts() -> int:
+    """Dedup muddati o'tgan tugagan tarqatishlar fayllarini o'chirish"""
+    removed = 0
+    for state in list(iter_broadcast_states()):
+        if broadcast_is_recent(state):
+            continue
+        for filename in (broadcast_state_file(state["id"]), broadcast_log_file(state["id"])):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Faylni o'chirishda xatolik: {e}")
+        removed += 1
+    if removed:
+        logger.info(f"🧹 {removed} ta eski tarqatish fayllari o'chirildi")
+    return removed
+
+class BroadcastJob:
+    """Bitta tarqatish: qabul qiluvchilar, navbatdagi o'rin va natijalar"""
+
+    def __init__(self, job_id: str, text: str, recipients: List[int], status_chat_id: int, status_message_id: int,
+                 delivered: set = frozenset()):
+        self.id = job_id
+        self.text = text
+        self.parse_mode: Optional[str] = 'Markdown'
+        self.recipients = recipients
+        self.status_chat_id = status_chat_id
+        self.status_message_id = status_message_id
+        # Oldingi urinishlarda yetkazilganlar qayta yuborilmaydi
+        self.pending = [uid for uid in recipients if uid not in delivered]
+        self.skipped = len(recipients) - len(self.pending)
+        self.cursor = 0
+        self.sent = 0
+        self.failed = 0
+        self.gone = 0
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def done_count(self) -> int:
+        return self.sent + self.failed + self.gone
+
+    def save(self, status: str):
+        save_data(broadcast_state_file(self.id), {
+            "id": self.id,
+            "text": self.text,
+            "recipients": self.recipients,
+            "status_chat_id": self.status_chat_id,
+            "status_message_id": self.status_message_id,
+            "status": status,
+            "updated_at": datetime.now().isoformat(),
+        })
+
+    def record(self, chat_id: int, result: str):
+        data_writer.append(broadcast_log_file(self.id), f"{chat_id} {result}\n")
+
+    def progress_text(self, rate: float, final: bool = False) -> str:
+        elapsed = time.monotonic() - self.started
+        remaining = len(self.pending) - self.done_count
+        counts = (
+            f"✅ Yuborildi: {self.sent}\n"
+            f"❌ Xatolik: {self.failed}\n"
+            f"🚫 Bloklagan: {self.gone}\n"
+        )
+        if self.skipped:
+            counts += f"⏭ Oldin yuborilgan: {self.skipped}\n"
+        if final:
+            if not self.pending and self.skipped:
+                return (
+                    f"ℹ️ Bu xabar yaqinda hammaga yuborilgan, hech kimga qayta yuborilmadi.\n\n{counts}"
+                    f"♻️ Hammaga qaytadan: /broadcast {BROADCAST_FORCE_FLAG} Xabar matni"
+                )
+            title = "⛔ Tarqatish to'xtatildi" if self.cancelled else "✅ Xabar yuborildi!"
+            return f"{title}\n\n{counts}⏱ Vaqt: {elapsed:.0f} s"
+        title = "⛔ To'xtatilmoqda..." if self.cancelled else "📢 Xabar tarqatilmoqda..."
+        return f"{title}\n\n{counts}⏳ Qoldi: {remaining}\n⏱ Taxminan {remaining / rate:.0f} s qoldi"
+
+class BroadcastEngine:
+    """Fonda tarqatish: umumiy tezlik cheklovi, RetryAfter bo'lsa sekinlashish"""
+
+    def __init__(self, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY):
+        self.max_rate = rate
+        self.rate = rate
+        self.concurrency = concurrency
+        self._next_slot = 0.0
+        self._clean_sends = 0
+        self._jobs: Dict[str, BroadcastJob] = {}
+
+    async def _pace(self):
+        """Navbatdagi yuborish vaqtini kutish (barcha tarqatishlar uchun umumiy)"""
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _backoff(self, retry_after: float):
+        """Telegram cheklovi: hamma kutadi, tezlik ikki barobar kamayadi"""
+        self._next_slot = max(self._next_slot, time.monotonic() + retry_after)
+        self.rate = max(1.0, self.rate / 2)
+        self._clean_sends = 0
+        logger.warning(f"⏳ Tarqatish: RetryAfter {retry_after:.0f} s, tezlik {self.rate:.0f} xabar/s")
+
+    def _recovered(self):
+        """Muammosiz yuborishlardan keyin tezlikni asta-sekin tiklash"""
+        if self.rate >= self.max_rate:
+            return
+        self._clean_sends += 1
+        if self._clean_sends >= self.rate:
+            self._clean_sends = 0
+            self.rate = min(self.max_rate, self.rate + 1)
+
+    async def _deliver(self, bot, job: BroadcastJob, chat_id: int) -> str:
+        for _ in range(BROADCAST_MAX_ATTEMPTS):
+            await self._pace()
+            try:
+                await bot.send_message(chat_id=chat_id, text=job.text, parse_mode=job.parse_mode)
+                self._recovered()
+                return SENT
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                self._backoff(retry_after.total_seconds() if isinstance(retry_after, timedelta) else retry_after)
+            except BadRequest as e:
+                if job.parse_mode and "parse" in str(e).lower():
+                    # Markdown xatosi: qolganlarga oddiy matn sifatida
+                    job.parse_mode = None
+                    continue
+                if "chat not found" in str(e).lower():
+                    user_store.mark_inactive(chat_id, "chat not found")
+                    return GONE
+                return FAILED
+            except Forbidden as e:
+                # Botni bloklagan yoki akkauntini o'chirgan
+                user_store.mark_inactive(chat_id, str(e)[:100])
+                return GONE
+            except NetworkError:
+                continue
+            except TelegramError:
+                return FAILED
+        return FAILED
+
+    async def _worker(self, bot, job: BroadcastJob):
+        while not job.cancelled and job.cursor < len(job.pending):
+            chat_id = job.pending[job.cursor]
+            job.cursor += 1
+            result = await self._deliver(bot, job, chat_id)
+            job.record(chat_id, result)
+            if result == SENT:
+                job.sent += 1
+            elif result == GONE:
+                job.gone += 1
+            else:
+                job.failed += 1
+
+    async def _show_progress(self, bot, job: BroadcastJob, final: bool = False):
+        keyboard = None if final else InlineKeyboardMarkup([[
+            InlineKeyboardButton("⛔ To'xtatish", callback_data=f"broadcast_cancel:{job.id}")
+        ]])
         try:
-            await context.bot.send_message(
-                chat_id=int(uid),
-                text=f"📢 *Admin xabari:*\n\n{message}",
-                parse_mode='Markdown'
+            await bot.edit_message_text(
+                job.progress_text(self.rate, final),
+                chat_id=job.status_chat_id,
+                message_id=job.status_message_id,
+                reply_markup=keyboard
             )
-            sent += 1
-            await asyncio.sleep(0.1)  # Rate limit
-        except Exception as e:
-            failed += 1
-    
-    await update.message.reply_text(
-        f"✅ Xabar yuborildi!\n\n"
-        f"✅ Yuborildi: {sent}\n"
-        f"❌ Xatolik: {failed}"
-    )
+        except TelegramError as e:
+            logger.debug(f"Tarqatish holatini yangilab bo'lmadi: {e}")
+
+    async def _run(self, bot, job: BroadcastJob):
+        async def report():
+            while True:
+                await self._show_progress(bot, job)
+                await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+
+        reporter = asyncio.create_task(report())
+        try:
+            await asyncio.gather(*[
+                self._worker(bot, job) for _ in range(max(1, min(self.concurrency, len(job.pending))))
+            ])
+        finally:
+            reporter.cancel()
+            self._jobs.pop(job.id, None)
+        # To'xtatilgan yoki tugagan tarqatish qayta ishga tushganda davom ettirilmaydi
+        job.save("cancelled" if job.cancelled else "done")
+        await self._show_progress(bot, job, final=True)
+        logger.info(
+            f"📢 Tarqatish {job.id} tugadi: {job.sent} yuborildi, {job.failed} xatolik, {job.gone} bloklagan"
+        )
+
+    def is_running(self, text: str) -> bool:
+        return any(job.text == text for job in self._jobs.values())
+
+    def _launch(self, bot, job: BroadcastJob) -> BroadcastJob:
+        self._jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(bot, job))
+        return job
+
+    async def start(self, bot, text: str, recipients: List[int], status_chat_id: int, status_message_id: int,
+                    job_id: Optional[str] = None) -> BroadcastJob:
+        """Tarqatishni boshlash (job_id berilsa, o'sha tarqatishda yetkazilganlarga takror yuborilmaydi)"""
+        # Jurnal event loop'dan tashqarida o'qiladi: katta tarqatishda handler to'xtab qolmaydi
+        delivered = await asyncio.to_thread(broadcast_delivered, job_id) if job_id else frozenset()
+        job = BroadcastJob(
+            job_id or new_broadcast_id(text), text, recipients, status_chat_id, status_message_id, delivered
+        )
+        job.save("running")
+        return self._launch(bot, job)
+
+    async def resume(self, bot) -> int:
+        """Bot to'xtaganda tugamay qolgan tarqatishlarni davom ettirish"""
+        await asyncio.to_thread(prune_broadcasts)
+        resumed = 0
+        for state in await asyncio.to_thread(lambda: list(iter_broadcast_states())):
+            if state.get("status") != "running" or state.get("id") in self._jobs:
+                continue
+            job = BroadcastJob(
+                state["id"], state["text"], state["recipients"],
+                state["status_chat_id"], state["status_message_id"],
+                await asyncio.to_thread(broadcast_delivered, state["id"])
+            )
+            logger.info(f"🔁 Tarqatish {job.id} davom ettirilmoqda: {len(job.pending)} ta qoldi")
+            self._launch(bot, job)
+            resumed += 1
+        return resumed
+
+    def cancel(self, job_id: str) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancelled = True
+        return True
+
+    async def shutdown(self):
+        """Bot to'xtayotganda tarqatishlarni to'xtatish (holati saqlanadi, keyin davom etadi)"""
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+broadcast_engine = BroadcastEngine()
 
 # ==================== CALLBACK HANDLER ====================
 
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Callback querylarni boshqarish"""
     query = update.callback_query
+    # Cheklov javobi query.answer orqali beriladi, shuning uchun undan oldin
+    if await rate_limited(update, "update") or (query.data == "new_code" and await rate_limited(update, "code")):
+        return
     await query.answer()
     
     user_id = update.effective_user.id
     data = query.data
     
     if data == "check_subscription":
-        is_subscribed, not_subscribed = await check_channel_subscription(user_id, context)
+        # Foydalanuvchi hozirgina obuna bo'lgan bo'lishi mumkin: keshsiz tekshirish
+        is_subscribed, not_subscribed = await check_channel_subscription(user_id, context, force=True)
         
         if is_subscribed:
             await query.edit_message_text(
@@ -755,21 +3424,27 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 for i, ch in enumerate(channels, 1):
                     message += f"{i}. {ch.get('title')} (@{ch.get('username')})\n"
             
+            ttls = settings.get("subscription_cache", DEFAULT_SETTINGS["subscription_cache"])
+            membership = membership_cache.stats()
+            index = membership_index.stats()
+            message += f"\n💾 A'zolik keshi: a'zo {ttls.get('member_ttl', 600)} s, a'zo emas {ttls.get('nonmember_ttl', 30)} s\n"
+            message += f"Topildi: {membership['hits']} | Topilmadi: {membership['misses']} ({membership['hit_ratio']:.0%})\n"
+            message += f"📇 A'zolik indeksi: {index['channels']} kanal, {index['known']} yozuv, {index['hits']} marta ishlatildi, {index['stale']} qayta tekshirildi\n"
+            
             message += "\n📝 Buyruqlar:\n"
             message += "/addchannel @username Nomi - Kanal qo'shish\n"
-            message += "/removechannel @username - Kanalni o'chirish"
+            message += "/removechannel @username - Kanalni o'chirish\n"
+            message += "/subcache 600 30 - A'zolik keshi muddatlari (soniya)"
             
             await query.edit_message_text(message, parse_mode='Markdown')
         
         elif action == "users":
-            users = get_users()
-            total = len(users.get("users", {}))
+            total = user_store.count()
             
             message = f"👥 *Foydalanuvchilar:* {total}\n\n"
             
             # Oxirgi 10 ta
-            user_list = list(users.get("users", {}).values())[-10:]
-            for u in reversed(user_list):
+            for u in user_store.recent(10):
                 username = f"@{u.get('username')}" if u.get('username') else "—"
                 message += f"• {u.get('first_name')} ({username})\n"
             
@@ -777,13 +3452,32 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         elif action == "ai":
             settings = get_settings()
+            cache = answer_cache.stats()
+            queue = ai_scheduler.stats()
+            
+            state_icons = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}
+            router_lines = "\n".join(
+                f"• {p['name'].capitalize()}: {state_icons[p['state']]} p50 {p['p50']:.1f}s, "
+                f"xato {p['error_rate']:.0%}, so'rov {p['requests']}"
+                for p in provider_router.status()
+            )
             
             message = f"""🤖 *AI Sozlamalari*
 
 • Holat: {'✅ Yoqilgan' if settings.get('ai_enabled') else '❌ O\'chirilgan'}
 • Provider: {settings.get('ai_provider', 'gemini').upper()}
 • Gemini: {'✅' if gemini_model else '❌'}
-• OpenAI: {'✅' if openai_client else '❌'}"""
+• OpenAI: {'✅' if openai_client else '❌'}
+
+💾 *Javoblar keshi:*
+• Javoblar: {cache['size']}
+• Topildi: {cache['hits']} | Topilmadi: {cache['misses']} ({cache['hit_ratio']:.0%})
+• Tejalgan vaqt: {cache['saved_seconds']:.0f} s
+
+🔀 *Provayderlar holati:*
+{router_lines}
+
+⏳ *Navbat:* {queue['queued']}/{queue['limit']} kutmoqda, {queue['active']}/{queue['slots']} ishlamoqda"""
             
             keyboard = [
                 [InlineKeyboardButton(
@@ -800,30 +3494,42 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         
         elif action == "stats":
-            users = get_users()
-            codes = get_codes()
-            
-            total_users = len(users.get("users", {}))
-            total_codes = len(codes.get("codes", {}))
-            used_codes = len([c for c in codes.get("codes", {}).values() if c.get("used")])
+            total_users = user_store.count()
+            total_codes, used_codes = code_table.stats()
+            cache = conversation_cache.stats()
             
             message = f"""📊 *Statistika*
 
 👥 Foydalanuvchilar: {total_users}
 🔑 Jami kodlar: {total_codes}
 ✅ Ishlatilgan: {used_codes}
-⏳ Faol: {total_codes - used_codes}"""
+⏳ Faol: {total_codes - used_codes}
+
+💬 *Suhbat keshi:*
+• Foydalanuvchilar: {cache['users']}
+• Xotira: {cache['bytes'] // 1024} / {cache['budget'] // 1024} KB
+• Topildi: {cache['hits']} | Topilmadi: {cache['misses']} ({cache['hit_ratio']:.0%})
+• Chiqarildi: {cache['evictions']}
+
+🚦 Cheklangan so'rovlar: {rate_limiter.rejected}"""
             
             await query.edit_message_text(message, parse_mode='Markdown')
         
         elif action == "back":
             await admin_panel(update, context)
     
+    elif data.startswith("broadcast_cancel:"):
+        if user_id not in ADMIN_IDS:
+            return
+        
+        if broadcast_engine.cancel(data.split(":", 1)[1]):
+            logger.info(f"⛔ Tarqatish to'xtatildi ({user_id})")
+    
     elif data == "toggle_ai":
         if user_id not in ADMIN_IDS:
             return
         
-        settings = get_settings()
+        settings = get_settings_copy()
         settings["ai_enabled"] = not settings.get("ai_enabled", True)
         save_settings(settings)
         
@@ -844,6 +3550,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text
     
+    if await rate_limited(update, "update"):
+        return
+    
     # Kanal obunasini tekshirish
     is_subscribed, not_subscribed = await check_channel_subscription(user_id, context)
     
@@ -888,18 +3597,260 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # AI ga yuborish
         settings = get_settings()
         if settings.get("ai_enabled", True) and len(text) > 2:
-            await process_ai_message(update, context, text)
+            if await rate_limited(update, "ai"):
+                return
+            ai_sessions.submit(update, context, text)
         else:
             await update.message.reply_text(
                 "Iltimos, tugmalardan birini tanlang yoki /help buyrug'ini ishlating."
             )
 
+# ==================== UPDATE'LARNI PARALLEL QAYTA ISHLASH ====================
+
+# Bir vaqtda qayta ishlanadigan update'lar soni (turli foydalanuvchilarniki)
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '32'))
+
+# Qayta ishlanayotgan va navbatda kutayotgan update'lar chegarasi: to'lsa yangi update olinmaydi
+UPDATE_BACKLOG = int(os.getenv('UPDATE_BACKLOG', '1024'))
+
+# Hali olinmagan update'lar navbati hajmi: to'lsa polling to'xtaydi, webhook javobi kutadi
+# (ortiqcha update'lar Telegram tomonida qoladi va keyinroq yetkaziladi)
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '256'))
+
+# Bitta foydalanuvchining navbatdagi update'lari chegarasi (spamga qarshi: oshsa "band" deb javob beriladi)
+UPDATE_USER_BACKLOG = int(os.getenv('UPDATE_USER_BACKLOG', '20'))
+
+# Update rad etilganda foydalanuvchiga yuboriladigan xabar
+UPDATE_BUSY_TEXT = "⏳ Bot hozir band, so'rovlaringiz navbatda. Birozdan keyin qayta urinib ko'ring."
+
+def update_key(update) -> Optional[int]:
+    """Tartibi saqlanadigan guruh: foydalanuvchi, bo'lmasa chat"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Turli foydalanuvchilarning update'lari parallel, bitta foydalanuvchiniki ketma-ket"""
+
+    def __init__(self, workers: int = UPDATE_WORKERS, backlog: int = UPDATE_BACKLOG,
+                 user_backlog: int = UPDATE_USER_BACKLOG):
+        # PTB har bir update uchun darhol task yaratadi, semafori esa faqat ularni kuttiradi.
+        # Shuning uchun u cheklamaydi: o'rinlarni UpdateQueue update olishdan oldin band qiladi
+        super().__init__(sys.maxsize)
+        self.workers = workers
+        self.backlog = backlog
+        self.user_backlog = user_backlog
+        # Ishchi o'rni foydalanuvchi navbati kelgandagina olinadi: kutayotgan o'rin band qilmaydi
+        self._worker_slots = asyncio.Semaphore(workers)
+        # Qayta ishlanayotgan yoki kutayotgan update'lar o'rinlari
+        self._backlog_slots = asyncio.Semaphore(backlog)
+        # Navbatdan olishda band qilingan, lekin hali qayta ishlashga kelmagan o'rinlar
+        self._reserved = 0
+        # foydalanuvchi -> [qulf, shu foydalanuvchining update'lari soni]
+        self._locks: Dict[int, list] = {}
+        self.dropped = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def reserve(self):
+        """Bo'sh o'rin paydo bo'lguncha kutish (keyingi update navbatdan shundan keyin olinadi)"""
+        await self._backlog_slots.acquire()
+        self._reserved += 1
+
+    def unreserve(self):
+        """Band qilingan o'rin update'ga ishlatilmadi"""
+        self._reserved -= 1
+        self._backlog_slots.release()
+
+    async def _reject(self, update, coroutine, key: int):
+        """Foydalanuvchi navbati to'la: update bajarilmaydi, lekin foydalanuvchi javobsiz qolmaydi"""
+        coroutine.close()
+        self.dropped += 1
+        if self.dropped % 100 == 1:
+            logger.warning(f"⚠️ Foydalanuvchi navbati to'la, update rad etildi: {key} (jami {self.dropped})")
+        try:
+            if update.callback_query:
+                # Javobsiz callback tugmani "yuklanmoqda" holatida qoldiradi
+                await update.callback_query.answer(UPDATE_BUSY_TEXT)
+            elif update.effective_message and rate_limiter.should_notify(key):
+                await update.effective_message.reply_text(UPDATE_BUSY_TEXT)
+        except TelegramError as e:
+            logger.warning(f"⚠️ Band xabarini yuborib bo'lmadi: {e}")
+
+    async def do_process_update(self, update, coroutine):
+        # UpdateQueue band qilgan o'rin ishlatiladi, to'g'ridan-to'g'ri chaqiruv o'zi kutadi
+        if self._reserved:
+            self._reserved -= 1
+        else:
+            await self._backlog_slots.acquire()
+        try:
+            key = update_key(update)
+            entry = self._locks.get(key) if key is not None else None
+            if entry is not None and entry[1] >= self.user_backlog:
+                await self._reject(update, coroutine, key)
+                return
+            if key is None:
+                async with self._worker_slots:
+                    await coroutine
+                return
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                # asyncio.Lock navbati FIFO: update'lar kelgan tartibda bajariladi
+                async with entry[0]:
+                    async with self._worker_slots:
+                        await coroutine
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+        finally:
+            self._backlog_slots.release()
+
+class UpdateQueue(asyncio.Queue):
+    """Update navbati: protsessorda o'rin bo'shamaguncha keyingi update olinmaydi.
+    Navbat to'lganda polling va webhook ham kutadi, ya'ni bosim Telegram'gacha yetadi"""
+
+    def __init__(self, processor: PerUserUpdateProcessor, maxsize: int = UPDATE_QUEUE_SIZE):
+        super().__init__(maxsize)
+        self.processor = processor
+
+    async def get(self):
+        await self.processor.reserve()
+        try:
+            item = await super().get()
+        except BaseException:
+            self.processor.unreserve()
+            raise
+        # To'xtatish signali protsessorga bormaydi
+        if not isinstance(item, Update):
+            self.processor.unreserve()
+        return item
+
+# ==================== WEBHOOK ====================
+
+# Ishlash rejimi: polling (standart) yoki webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').strip().lower()
+
+# Webhook: tashqi manzil (masalan, https://ielts-bot.fly.dev), yo'l va tinglash porti
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8080'))
+
+# Webhook'ni Telegram'da o'rnatish (0 - mahalliy sinov: set_webhook chaqirilmaydi, ishlayotgan bot buzilmaydi)
+WEBHOOK_REGISTER = os.getenv('WEBHOOK_REGISTER', '1').strip().lower() not in ('0', 'false', 'no')
+
+# Telegram har bir so'rovda yuboradigan maxfiy kalit (berilmasa tokendan hosil qilinadi)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()[:32]
+
+# So'rovni o'qish uchun vaqt va hajm chegarasi
+WEBHOOK_READ_TIMEOUT = 10
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large"}
+
+class WebhookServer:
+    """Telegram webhook va /health uchun kichik HTTP server (qo'shimcha kutubxonasiz)"""
+
+    def __init__(self, application: Application, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 listen: str = WEBHOOK_LISTEN, port: int = PORT):
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.listen = listen
+        self.port = port
+        self.received = 0
+        self.started = time.monotonic()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.listen, self.port)
+        logger.info(f"🌐 Webhook {self.listen}:{self.port}{self.path} da tinglanmoqda")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            async with asyncio.timeout(WEBHOOK_READ_TIMEOUT):
+                method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length') or 0)
+                if length > WEBHOOK_MAX_BODY:
+                    status, payload = 413, {}
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self._dispatch(method, target.split('?', 1)[0], headers, body)
+        except (TimeoutError, ValueError, asyncio.IncompleteReadError):
+            status, payload = 400, {}
+        except Exception as e:
+            logger.error(f"Webhook xatolik: {e}")
+            status, payload = 400, {}
+        body = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode('latin-1') + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        if path == '/health':
+            if method not in ('GET', 'HEAD'):
+                return 405, {}
+            return 200, {
+                "status": "ok",
+                "mode": "webhook",
+                "uptime": round(time.monotonic() - self.started),
+                "received": self.received,
+                "queued": self.application.update_queue.qsize(),
+            }
+        if path != self.path:
+            return 404, {}
+        if method != 'POST':
+            return 405, {}
+        # Faqat Telegram (maxfiy kalitni biladigan) yuborgan so'rovlar qabul qilinadi
+        if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), self.secret):
+            return 403, {}
+        update = Update.de_json(json.loads(body), self.application.bot)
+        if update is None:
+            return 400, {}
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return 200, {}
+
 # ==================== MAIN ====================
 
-async def run_bot():
-    """Botni async ishga tushirish"""
-    # Bot yaratish
-    application = Application.builder().token(BOT_TOKEN).build()
+def build_application(builder=None) -> Application:
+    """Application yaratish va handlerlarni ulash"""
+    if builder is None:
+        builder = Application.builder().token(BOT_TOKEN)
+    # Bir foydalanuvchining uzoq so'rovi boshqalarni kuttirmaydi
+    processor = PerUserUpdateProcessor()
+    application = builder.concurrent_updates(processor).update_queue(UpdateQueue(processor)).build()
     
     # Handlerlar
     application.add_handler(CommandHandler("start", start))
@@ -910,10 +3861,23 @@ async def run_bot():
     application.add_handler(CommandHandler("addchannel", admin_add_channel))
     application.add_handler(CommandHandler("removechannel", admin_remove_channel))
     application.add_handler(CommandHandler("channels", admin_list_channels))
+    application.add_handler(CommandHandler("subcache", admin_subscription_cache))
+    application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(track_bot_status, ChatMemberHandler.MY_CHAT_MEMBER))
     application.add_handler(CommandHandler("broadcast", admin_broadcast))
     application.add_handler(CallbackQueryHandler(handle_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
+    return application
+
+async def run_bot():
+    """Botni async ishga tushirish"""
+    # Bot yaratish
+    application = build_application()
+    
+    # Foydalanuvchilar, kodlar va keshlar update'lardan oldin yuklanadi
+    await preload_stores()
+    
     # Botni ishga tushirish
     logger.info("=" * 50)
     logger.info("🤖 IELTS Pro Bot ishga tushmoqda...")
@@ -926,28 +3890,67 @@ async def run_bot():
     async with application:
         await application.initialize()
         await application.start()
-        await application.updater.start_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True
-        )
+        # Yozuvchi birinchi update'dan oldin ishga tushadi: handlerlar diskni kutmaydi
+        data_writer.start()
         
-        logger.info("✅ Bot ishga tushdi! To'xtatish uchun Ctrl+C bosing.")
-        
-        # Bot ishlayotgan paytda kutish
         try:
-            while True:
-                await asyncio.sleep(1)
-        except asyncio.CancelledError:
-            pass
-        
-        await application.updater.stop()
-        await application.stop()
+            webhook_server = None
+            if BOT_MODE == 'webhook':
+                if WEBHOOK_REGISTER and not WEBHOOK_URL:
+                    raise RuntimeError("Webhook rejimi uchun WEBHOOK_URL kerak")
+                webhook_server = WebhookServer(application)
+                await webhook_server.start()
+                if WEBHOOK_REGISTER:
+                    await application.bot.set_webhook(
+                        url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                        secret_token=WEBHOOK_SECRET,
+                        allowed_updates=Update.ALL_TYPES,
+                        drop_pending_updates=True
+                    )
+                else:
+                    logger.info("🧪 Mahalliy sinov: webhook Telegram'da o'rnatilmadi (WEBHOOK_REGISTER=0)")
+            else:
+                await application.updater.start_polling(
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True
+                )
+            
+            logger.info(f"✅ Bot ishga tushdi ({BOT_MODE})! To'xtatish uchun Ctrl+C bosing.")
+            
+            background_tasks = [
+                asyncio.create_task(periodic_flush()),
+                asyncio.create_task(code_sweeper()),
+                asyncio.create_task(history_compactor()),
+                # Gemini modelini fonda aniqlash (update'lar kutmaydi)
+                asyncio.create_task(ensure_gemini_model()),
+            ]
+            
+            # Bot ishlayotgan paytda kutish
+            try:
+                await broadcast_engine.resume(application.bot)
+                while True:
+                    await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                for task in background_tasks:
+                    task.cancel()
+                await broadcast_engine.shutdown()
+            
+            if webhook_server is not None:
+                await webhook_server.stop()
+            else:
+                await application.updater.stop()
+            # Navbatdagi update'lar shu yerda qayta ishlanadi
+            await application.stop()
+        finally:
+            # Oxirgi o'zgarishlar barcha update'lardan keyin yoziladi
+            flush_all()
+            await data_writer.close()
         await application.shutdown()
 
 def main():
     """Botni ishga tushirish"""
-    import time
-    
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN topilmadi!")
         return
@@ -955,6 +3958,11 @@ def main():
     # Ma'lumotlar papkasini yaratish
     ensure_data_dir()
     
+    # JSON → SQLite ko'chirish: python ielts_bot.py migrate
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrate':
+        migrate_json_to_sqlite(SqliteStorage(SQLITE_FILE, auto_migrate=False))
+        return
+    
     # Eskirgan kodlarni tozalash
     cleanup_expired_codes()
     
@@ -0,0 +1,130 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ielts_bot  # noqa: E402
+
+
+def opened(health):
+    health._open("test")
+    health.opened_at = time.monotonic() - ielts_bot.ROUTER_COOLDOWN - 1
+    return health
+
+
+class ProviderHealthTest(unittest.TestCase):
+    def test_available_does_not_change_state(self):
+        health = opened(ielts_bot.ProviderHealth("openai"))
+        self.assertTrue(health.available())
+        self.assertTrue(health.available())
+        self.assertEqual(health.state, "open")
+
+    def test_begin_starts_single_trial(self):
+        health = opened(ielts_bot.ProviderHealth("openai"))
+        self.assertIs(health.begin(), True)
+        self.assertEqual(health.state, "half_open")
+        self.assertIsNone(health.begin())
+        self.assertFalse(health.available())
+
+    def test_abort_trial_rearms_cooldown(self):
+        health = opened(ielts_bot.ProviderHealth("openai"))
+        health.begin()
+        health.abort_trial()
+        self.assertEqual(health.state, "open")
+        self.assertFalse(health.available())
+
+    def test_trial_outcome_closes_or_reopens(self):
+        health = opened(ielts_bot.ProviderHealth("openai"))
+        health.begin()
+        health.record_success(0.1)
+        self.assertEqual(health.state, "closed")
+
+        health = opened(ielts_bot.ProviderHealth("openai"))
+        health.begin()
+        health.record_failure()
+        self.assertEqual(health.state, "open")
+        self.assertFalse(health.available())
+
+
+class ProviderRouterTest(unittest.IsolatedAsyncioTestCase):
+    async def test_untried_provider_stays_open(self):
+        router = ielts_bot.ProviderRouter(["gemini", "openai"])
+        opened(router.health["openai"])
+
+        async def gemini(partial):
+            return "gemini javobi"
+
+        async def openai(partial):
+            raise AssertionError("chaqirilmasligi kerak")
+
+        answer = await router.route("gemini", {"gemini": gemini, "openai": openai})
+        self.assertEqual(answer, "gemini javobi")
+        self.assertEqual(router.health["openai"].state, "open")
+        self.assertTrue(router.health["openai"].available())
+
+    async def test_cancelled_trial_reopens_circuit(self):
+        router = ielts_bot.ProviderRouter(["openai"])
+        opened(router.health["openai"])
+        started = asyncio.Event()
+
+        async def openai(partial):
+            started.set()
+            await asyncio.sleep(10)
+
+        task = asyncio.create_task(router.route("openai", {"openai": openai}))
+        await started.wait()
+        self.assertEqual(router.health["openai"].state, "half_open")
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertEqual(router.health["openai"].state, "open")
+        self.assertFalse(router.health["openai"].available())
+
+        with mock.patch.object(ielts_bot, "ROUTER_COOLDOWN", 0):
+            async def recovered(partial):
+                return "javob"
+            self.assertEqual(await router.route("openai", {"openai": recovered}), "javob")
+        self.assertEqual(router.health["openai"].state, "closed")
+
+
+class CachedAnswerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_cache_hit_leaves_half_open_circuit_unchanged(self):
+        router = ielts_bot.ProviderRouter(["gemini", "openai"])
+        health = opened(router.health["openai"])
+        health.begin()
+        cache = ielts_bot.ResponseCache(10, 3600)
+        question = "Cache hit savoli"
+        key = cache.key(question, ielts_bot.DEFAULT_SETTINGS["ai_system_prompt"], "openai", ielts_bot.OPENAI_MODEL)
+        cache.put(key, "keshdagi javob", 5.0)
+        calls = []
+
+        async def ask_openai(messages, partial=None):
+            calls.append(messages)
+            return "yangi javob"
+
+        with mock.patch.multiple(
+            ielts_bot,
+            provider_router=router,
+            answer_cache=cache,
+            openai_client=object(),
+            gemini_model=None,
+            ask_openai=ask_openai,
+            ensure_gemini_model=mock.AsyncMock(return_value=None),
+        ):
+            answer = await ielts_bot.get_ai_response(question, 987654321)
+
+        self.assertEqual(answer, "keshdagi javob")
+        self.assertEqual(calls, [])
+        self.assertEqual(health.state, "half_open")
+        self.assertEqual(health.requests, 0)
+        self.assertEqual(len(health.latencies), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
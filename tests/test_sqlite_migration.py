@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ielts_bot  # noqa: E402
+
+
+class SqliteMigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        paths = {
+            "DATA_DIR": self.data_dir,
+            "USERS_FILE": "users.json",
+            "CODES_FILE": "codes.json",
+            "SETTINGS_FILE": "settings.json",
+            "CHAT_HISTORY_FILE": "chat_history.json",
+            "CHAT_LOG_FILE": "chat_history.jsonl",
+            "MEMBERS_FILE": "members.jsonl",
+            "USERS_LOG_FILE": "users.jsonl",
+            "CHATS_DIR": "chats",
+            "USERS_DIR": "users",
+            "HISTORY_DIR": "history",
+        }
+        patcher = mock.patch.multiple(ielts_bot, **{
+            name: value if name == "DATA_DIR" else os.path.join(self.data_dir, value)
+            for name, value in paths.items()
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = os.path.join(self.data_dir, "bot.db")
+        self.users_file = os.path.join(self.data_dir, "users.json")
+        with open(self.users_file, "w", encoding="utf-8") as f:
+            json.dump({"users": {"1": {"last_active": "2024-01-01"}}}, f)
+
+    def open_storage(self):
+        storage = ielts_bot.SqliteStorage(self.db)
+        self.addCleanup(lambda: [conn.close() for conn in (storage._conn, storage._read_conn) if conn])
+        return storage
+
+    def test_failed_migration_is_retried_on_next_start(self):
+        with mock.patch.object(ielts_bot, "import_json_data", side_effect=RuntimeError("disk")):
+            with self.assertRaises(RuntimeError):
+                ielts_bot.SqliteStorage(self.db)._connect()
+        self.assertTrue(os.path.exists(self.users_file))
+
+        storage = self.open_storage()
+        self.assertEqual(list(storage.load_users()), ["1"])
+        self.assertFalse(os.path.exists(self.users_file))
+        self.assertTrue(os.path.exists(f"{self.users_file}.migrated"))
+
+    def test_marker_prevents_second_migration(self):
+        self.open_storage().load_users()
+        with open(self.users_file, "w", encoding="utf-8") as f:
+            json.dump({"users": {"2": {}}}, f)
+        self.assertEqual(list(self.open_storage().load_users()), ["1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ielts_bot  # noqa: E402
+
+
+def make_update(user_id, callback=False):
+    update = mock.MagicMock(spec=ielts_bot.Update)
+    update.effective_user.id = user_id
+    update.callback_query = mock.MagicMock() if callback else None
+    if callback:
+        update.callback_query.answer = mock.AsyncMock()
+    update.effective_message.reply_text = mock.AsyncMock()
+    return update
+
+
+class PerUserUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+    async def test_user_backlog_answers_rejected_callback(self):
+        processor = ielts_bot.PerUserUpdateProcessor(workers=2, backlog=10, user_backlog=1)
+        release = asyncio.Event()
+        first = asyncio.create_task(processor.do_process_update(make_update(1), release.wait()))
+        await asyncio.sleep(0)
+
+        update = make_update(1, callback=True)
+        handler = mock.AsyncMock()
+        await processor.do_process_update(update, handler())
+
+        update.callback_query.answer.assert_awaited_once_with(ielts_bot.UPDATE_BUSY_TEXT)
+        handler.assert_not_awaited()
+        self.assertEqual(processor.dropped, 1)
+        release.set()
+        await first
+
+    async def test_full_backlog_holds_next_update_in_queue(self):
+        processor = ielts_bot.PerUserUpdateProcessor(workers=2, backlog=1)
+        queue = ielts_bot.UpdateQueue(processor, maxsize=2)
+        first, second = make_update(1), make_update(2)
+        await queue.put(first)
+        await queue.put(second)
+
+        self.assertIs(await queue.get(), first)
+        release = asyncio.Event()
+        running = asyncio.create_task(processor.do_process_update(first, release.wait()))
+        waiting = asyncio.create_task(queue.get())
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+        self.assertEqual(queue.qsize(), 1)
+
+        release.set()
+        await running
+        self.assertIs(await waiting, second)
+
+
+if __name__ == "__main__":
+    unittest.main()